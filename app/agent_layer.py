@@ -90,13 +90,18 @@
 
 
 import os
+import copy
 import json
 import numpy as np
 from typing import List, Dict, Any
 
 from openai import OpenAI
-from app.rag_pipeline import rag_query, retrieve_candidates
-from app.utils import embed_text, normalize_embedding
+from app.rag_pipeline import (
+    rag_query, retrieve_candidates, retrieve_candidates_multi, generate_multi_cpt_suggestions,
+)
+from app.utils import embed_texts, normalize_embeddings
+from app.call_policy import get_policy
+from app.single_flight import get_flight, normalize_key
 
 # Use env var for auth
 client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
@@ -105,29 +110,30 @@ client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 # Similarity helpers
 # -----------------------
 
-def _cosine_similarity(vec1: np.ndarray, vec2: np.ndarray) -> float:
-    vec1 = normalize_embedding(vec1)
-    vec2 = normalize_embedding(vec2)
-    return float(np.dot(vec1, vec2.T))
-
 def _retrieval_score(note: str, candidates: List[Dict[str, Any]]) -> float:
     """Max cosine similarity between note and retrieved candidate texts."""
-    if not candidates:
+    texts = [c.get("text", "") for c in candidates]
+    texts = [t for t in texts if t]
+    if not texts:
         return 0.0
-    note_emb = embed_text(note)
-    sims = []
-    for c in candidates:
-        text = c.get("text", "")
-        if not text:
-            continue
-        c_emb = embed_text(text)
-        sims.append(_cosine_similarity(note_emb, c_emb))
-    return max(sims) if sims else 0.0
+    # One embeddings request for the note and all candidate texts
+    embs = normalize_embeddings(embed_texts([note] + texts))
+    return float(np.max(embs[1:] @ embs[0]))
 
 # -----------------------
 # Self-critique (verification) step
 # -----------------------
 
+def _verification_response(system_msg: str, user_msg: str, timeout: float):
+    """Single verification request; retries/hedging are handled by the call policy."""
+    return client.with_options(timeout=timeout, max_retries=0).responses.create(
+        model="gpt-4o-mini",
+        input=[
+            {"role": "system", "content": system_msg},
+            {"role": "user", "content": user_msg},
+        ],
+    )
+
 def _verify_suggestion(note: str,
                        suggestion: Dict[str, Any],
                        candidates: List[Dict[str, Any]]) -> Dict[str, Any]:
@@ -164,13 +170,7 @@ def _verify_suggestion(note: str,
     )
 
     try:
-        resp = client.responses.create(
-            model="gpt-4o-mini",
-            input=[
-                {"role": "system", "content": system_msg},
-                {"role": "user", "content": user_msg},
-            ],
-        )
+        resp = get_policy("verify").call(_verification_response, system_msg, user_msg)
         raw = resp.output_text
         # Attempt to parse JSON (strip code fences if any)
         cleaned = raw.strip()
@@ -220,6 +220,25 @@ def _decide_next_action(confidence: float, verdict: str) -> str:
 # -----------------------
 
 def agentic_cpt_suggestion(note: str, top_k: int = 5) -> Dict[str, Any]:
+    """
+    Agentic CPT suggestion for a note. Concurrent requests for the same normalized
+    note share one in-flight computation (see app.single_flight.coalescing_stats).
+    """
+    key = ("single", normalize_key(note), top_k)
+    return copy.deepcopy(get_flight("agentic").do(key, _agentic_cpt_suggestion, note, top_k))
+
+
+async def agentic_cpt_suggestion_async(note: str, top_k: int = 5, mode: str = "single"):
+    """
+    Asyncio entry point for the agentic flows ('single' or 'multi' mode).
+    Tasks and threads asking for the same note/mode are coalesced together.
+    """
+    fn = _agentic_cpt_suggestion if mode == "single" else _agentic_multi_cpt_suggestion
+    key = (mode, normalize_key(note), top_k)
+    return copy.deepcopy(await get_flight("agentic").do_async(key, fn, note, top_k))
+
+
+def _agentic_cpt_suggestion(note: str, top_k: int = 5) -> Dict[str, Any]:
     """
     Full agentic flow with a light self-critique loop.
     - Retrieve candidates (FAISS)
@@ -271,6 +290,60 @@ def agentic_cpt_suggestion(note: str, top_k: int = 5) -> Dict[str, Any]:
     return result
 
 
+def agentic_multi_cpt_suggestion(note: str, top_k: int = 5) -> List[Dict[str, Any]]:
+    """
+    Multi-procedure agentic suggestion; identical concurrent notes are coalesced.
+    """
+    key = ("multi", normalize_key(note), top_k)
+    return copy.deepcopy(get_flight("agentic").do(key, _agentic_multi_cpt_suggestion, note, top_k))
+
+
+def _agentic_multi_cpt_suggestion(note: str, top_k: int = 5) -> List[Dict[str, Any]]:
+    """
+    Agentic flow for notes describing several procedures.
+    - Split the note into procedure segments; batched retrieval for all of them
+    - Generate one suggestion per procedure in a single LLM call
+    - Verify each suggestion against its own segment (short, so nothing is truncated)
+    - Confidence reuses the FAISS scores from retrieval (no re-embedding)
+    """
+    segment_candidates = retrieve_candidates_multi(note, top_k=top_k)
+    by_segment = {s["segment"]: s["candidates"] for s in segment_candidates}
+    all_candidates = [c for s in segment_candidates for c in s["candidates"]]
+
+    suggestions = generate_multi_cpt_suggestions(note, segment_candidates)
+
+    results = []
+    for suggestion in suggestions:
+        if suggestion.get("error"):
+            results.append(suggestion)
+            continue
+        segment = suggestion.get("Segment")
+        if not isinstance(segment, str) or not segment:
+            segment = None
+        candidates = by_segment.get(segment) or all_candidates
+
+        verification = _verify_suggestion(segment or note, suggestion, candidates)
+        verdict = verification.get("verdict", "warn")
+        r_score = max((c.get("score", 0.0) for c in candidates), default=0.0)
+        confidence = _aggregate_confidence(r_score, verdict)
+
+        results.append({
+            **suggestion,
+            "Confidence": confidence,
+            "Next_Action": _decide_next_action(confidence, verdict),
+            "Verification": {
+                "verdict": verification.get("verdict"),
+                "short_rationale": verification.get("short_rationale"),
+                "missing_info": verification.get("missing_info", []),
+                "clarifying_questions": verification.get("clarifying_questions", []),
+                "supporting_snippets": verification.get("supporting_snippets", []),
+            },
+            "raw_verification_output": verification.get("raw_verification_output"),
+            "Evidence": [{"text": (c.get("text", "") or "")[:160]} for c in candidates[:3]],
+        })
+    return results
+
+
 def agentic_cpt_reverse_lookup(cpt_code: str) -> Dict[str, Any]:
     """
     (Unchanged) Simple wrapper for NL variants lookup + trivial confidence.
@@ -0,0 +1,335 @@
+"""
+Shared call policy for upstream (OpenAI) calls.
+
+Every LLM / embedding call goes through a named CallPolicy which adds:
+- a per-operation deadline (passed down to the client as a request timeout)
+- exponential backoff with full jitter on 429 / 5xx / connection errors
+- hedged duplicate requests once a call runs longer than the observed p95
+- a circuit breaker so callers can fall back (e.g. retrieval-only answers)
+"""
+
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# Status codes worth retrying: rate limits and transient server errors
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+# Client exception class names that signal a transient transport failure
+_RETRYABLE_EXC_NAMES = {"APITimeoutError", "APIConnectionError"}
+
+# Shared pool for attempts and hedges. Size it for peak concurrent callers x 2 (primary +
+# hedge); attempts still queued when their caller gives up are cancelled, and an attempt
+# that only starts after its deadline never reaches the upstream.
+CALL_POLICY_WORKERS = int(os.getenv("CALL_POLICY_WORKERS", 128))
+_executor = ThreadPoolExecutor(max_workers=CALL_POLICY_WORKERS, thread_name_prefix="call-policy")
+
+
+# -----------------------
+# Errors
+# -----------------------
+
+class CallPolicyError(Exception):
+    """Base class for failures raised by the call policy itself."""
+
+
+class CallTimeoutError(CallPolicyError):
+    """The operation did not complete within its deadline."""
+
+
+class CircuitOpenError(CallPolicyError):
+    """The circuit for this operation is open; callers should fall back."""
+
+
+def is_retryable(exc: Exception) -> bool:
+    """
+    Decide whether an exception from an upstream call is transient.
+    Args:
+        exc (Exception): raised exception
+    Returns:
+        bool: True for 429/5xx, timeouts and connection errors
+    """
+    status = getattr(exc, "status_code", None)
+    if status is not None:
+        return status in RETRYABLE_STATUS
+    if isinstance(exc, (TimeoutError, ConnectionError)):
+        return True
+    return any(cls.__name__ in _RETRYABLE_EXC_NAMES for cls in type(exc).__mro__)
+
+
+# -----------------------
+# Latency tracking
+# -----------------------
+
+class LatencyWindow:
+    """Sliding window of recent successful call latencies (seconds)."""
+
+    def __init__(self, size: int = 200):
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def quantile(self, q: float):
+        """Return the q-quantile of the window, or None when empty."""
+        with self._lock:
+            if not self._samples:
+                return None
+            ordered = sorted(self._samples)
+        pos = min(len(ordered) - 1, int(q * len(ordered)))
+        return ordered[pos]
+
+
+# -----------------------
+# Circuit breaker
+# -----------------------
+
+class CircuitBreaker:
+    """
+    Consecutive-failure circuit breaker.
+    closed -> open after `failure_threshold` failures; open -> half-open after `reset_timeout`.
+    Half-open lets exactly one probe call through (everyone else is still rejected);
+    its success closes the breaker, its failure re-opens it.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state_locked()
+
+    def _state_locked(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def allow(self) -> bool:
+        """Admit a call; in half-open only the first caller (the probe) is admitted."""
+        with self._lock:
+            state = self._state_locked()
+            if state == "closed":
+                return True
+            if state == "half-open" and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state_locked() == "half-open" or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+            self._probing = False
+
+    def release(self):
+        """End a call that says nothing about upstream health (e.g. a 400); frees the probe slot."""
+        with self._lock:
+            self._probing = False
+
+
+# -----------------------
+# Call policy
+# -----------------------
+
+class CallPolicy:
+    """
+    Deadline + retry + hedging + circuit breaker for one kind of upstream call.
+
+    `fn` passed to `call` must accept a `timeout` keyword (seconds) and forward it
+    to the client, so an individual attempt never outlives the overall deadline.
+    """
+
+    def __init__(self,
+                 name: str,
+                 deadline: float,
+                 max_retries: int = 3,
+                 backoff_base: float = 0.25,
+                 backoff_max: float = 4.0,
+                 hedge: bool = True,
+                 hedge_quantile: float = 0.95,
+                 hedge_min_samples: int = 20,
+                 failure_threshold: int = 5,
+                 reset_timeout: float = 30.0):
+        self.name = name
+        self.deadline = deadline
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_samples = hedge_min_samples
+        self.latencies = LatencyWindow()
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.stats = {"calls": 0, "retries": 0, "hedges": 0, "hedge_wins": 0,
+                      "timeouts": 0, "rejected": 0}
+        self._stats_lock = threading.Lock()
+
+    def _bump(self, key: str, n: int = 1):
+        with self._stats_lock:
+            self.stats[key] += n
+
+    def hedge_delay(self):
+        """Delay after which a duplicate request is sent, or None if hedging is inactive."""
+        if not self.hedge or len(self.latencies) < self.hedge_min_samples:
+            return None
+        return self.latencies.quantile(self.hedge_quantile)
+
+    def backoff(self, attempt: int) -> float:
+        """Full-jitter exponential backoff for the given retry attempt (0-based)."""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def call(self, fn, *args, **kwargs):
+        """
+        Run `fn(*args, timeout=..., **kwargs)` under this policy.
+        Returns:
+            whatever `fn` returns
+        Raises:
+            CircuitOpenError: circuit is open, caller should fall back
+            CallTimeoutError: deadline exceeded across all attempts
+            Exception: last non-retryable (or retries exhausted) upstream error
+        """
+        if not self.breaker.allow():
+            self._bump("rejected")
+            raise CircuitOpenError(f"{self.name}: circuit open")
+
+        self._bump("calls")
+        # One breaker outcome per logical call, however many attempts it took
+        try:
+            result = self._call_with_retries(fn, args, kwargs)
+        except CallTimeoutError:
+            self._bump("timeouts")
+            self.breaker.record_failure()
+            raise
+        except Exception as e:
+            if is_retryable(e):
+                self.breaker.record_failure()
+            else:
+                self.breaker.release()
+            raise
+        except BaseException:
+            self.breaker.release()
+            raise
+        self.breaker.record_success()
+        return result
+
+    def _call_with_retries(self, fn, args, kwargs):
+        deadline_at = time.monotonic() + self.deadline
+        attempt = 0
+        while True:
+            remaining = deadline_at - time.monotonic()
+            if remaining <= 0:
+                raise CallTimeoutError(f"{self.name}: deadline of {self.deadline}s exceeded")
+            try:
+                return self._hedged_attempt(fn, args, kwargs, deadline_at)
+            except CallTimeoutError:
+                raise
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+                # Stop early if other callers' failures opened the breaker meanwhile
+                if attempt >= self.max_retries or self.breaker.state == "open":
+                    raise
+                sleep_for = self.backoff(attempt)
+                if time.monotonic() + sleep_for >= deadline_at:
+                    raise
+                self._bump("retries")
+                time.sleep(sleep_for)
+                attempt += 1
+
+    def _hedged_attempt(self, fn, args, kwargs, deadline_at):
+        """One logical attempt: primary request plus at most one hedge after the p95 delay."""
+        def run():
+            started = time.monotonic()
+            if started >= deadline_at:
+                # Dequeued after the caller gave up: don't add load upstream
+                raise CallTimeoutError(f"{self.name}: attempt started after its deadline")
+            timeout = deadline_at - started
+            result = fn(*args, timeout=timeout, **kwargs)
+            self.latencies.record(time.monotonic() - started)
+            return result
+
+        primary = _executor.submit(run)
+        pending = {primary}
+        hedge_delay = self.hedge_delay()
+        hedged = None
+        last_error = None
+
+        try:
+            while pending:
+                remaining = deadline_at - time.monotonic()
+                if remaining <= 0:
+                    break
+                wait_for = remaining
+                if hedged is None and hedge_delay is not None:
+                    wait_for = min(remaining, hedge_delay)
+                done, pending = wait(pending, timeout=wait_for, return_when=FIRST_COMPLETED)
+
+                for fut in done:
+                    exc = fut.exception()
+                    if exc is None:
+                        if fut is hedged:
+                            self._bump("hedge_wins")
+                        return fut.result()
+                    last_error = exc
+
+                if not done and hedged is None and hedge_delay is not None:
+                    hedged = _executor.submit(run)
+                    self._bump("hedges")
+                    pending.add(hedged)
+
+            if last_error is not None and not pending:
+                raise last_error
+            raise CallTimeoutError(f"{self.name}: deadline of {self.deadline}s exceeded")
+        finally:
+            # Losers / abandoned attempts still queued never start; running ones finish
+            # in the background (bounded by their timeout) and their results are ignored
+            for fut in pending:
+                fut.cancel()
+
+
+# -----------------------
+# Registry
+# -----------------------
+
+# Per-operation deadlines (seconds)
+_POLICIES = {
+    "embed": CallPolicy("embed", deadline=10.0),
+    "generate": CallPolicy("generate", deadline=30.0),
+    "verify": CallPolicy("verify", deadline=20.0),
+}
+
+
+def get_policy(name: str) -> CallPolicy:
+    """Return the shared policy for an operation name ('embed', 'generate', 'verify')."""
+    return _POLICIES[name]
+
+
+def policy_stats():
+    """Snapshot of counters, p95 latency and circuit state per operation."""
+    return {
+        name: {**p.stats, "p95": p.latencies.quantile(0.95), "circuit": p.breaker.state}
+        for name, p in _POLICIES.items()
+    }
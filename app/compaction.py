@@ -0,0 +1,206 @@
+"""
+Semantic near-duplicate compaction of the variant corpus.
+
+A vectorized range search over normalized embeddings finds every pair of rows of the
+same CPT code with cosine similarity above a threshold. Those pairs are clustered
+(union-find); each cluster keeps one representative row: the description if
+the cluster has one, otherwise the medoid variant. Index and metadata are then
+rewritten together as one new knowledge-base version.
+
+One plan is computed from the live index vectors; the before/after report describes
+that plan and CPTUpdater.compact publishes exactly that plan.
+
+Usage (from the repo root):
+    python -m app.compaction [--threshold 0.92] [--dry-run] [--report report.json]
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+
+from app.utils import normalize_embeddings
+from app.evaluation import holdout_split, evaluate_config
+
+DEDUP_THRESHOLD = 0.92  # cosine similarity above which two variants of one code are duplicates
+
+
+def _find(parent, i):
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+
+def near_duplicate_clusters(vectors: np.ndarray, codes, threshold: float = DEDUP_THRESHOLD):
+    """
+    Cluster same-code rows whose cosine similarity is >= threshold.
+    Only same-code pairs can be merged, so the range search runs per code: one
+    thresholded similarity block per code instead of an all-pairs scan of the corpus.
+    Union-find makes this single-linkage clustering: a chain a~b~c lands in one
+    cluster even when a and c are below the threshold, so with a low threshold
+    variants that are not similar to each other can be merged.
+    Args:
+        vectors (np.ndarray): n x dim embeddings (normalized here)
+        codes (list[str]): CPT code per row
+        threshold (float): cosine similarity threshold
+    Returns:
+        list[list[int]]: clusters with more than one row (row ids, ascending)
+    """
+    vectors = normalize_embeddings(vectors)
+    rows_by_code = {}
+    for i, code in enumerate(codes):
+        rows_by_code.setdefault(code, []).append(i)
+
+    parent = list(range(len(codes)))
+    for rows in rows_by_code.values():
+        if len(rows) < 2:
+            continue
+        block = vectors[rows]
+        # Range search within the code: all pairs with similarity >= threshold
+        a_idx, b_idx = np.nonzero(np.triu(block @ block.T >= threshold, k=1))
+        for a, b in zip(a_idx.tolist(), b_idx.tolist()):
+            ra, rb = _find(parent, rows[a]), _find(parent, rows[b])
+            if ra != rb:
+                parent[max(ra, rb)] = min(ra, rb)
+
+    clusters = {}
+    for i in range(len(codes)):
+        clusters.setdefault(_find(parent, i), []).append(i)
+    return [members for members in clusters.values() if len(members) > 1]
+
+
+def select_representatives(clusters, vectors: np.ndarray, metadata):
+    """
+    Pick the rows to drop from each cluster.
+    Descriptions are always kept; a cluster without one keeps its medoid variant.
+    Returns:
+        set[int]: row ids to remove
+    """
+    vectors = normalize_embeddings(vectors)
+    drop = set()
+    for members in clusters:
+        descriptions = [i for i in members if metadata[i].get("source") == "description"]
+        if descriptions:
+            keep = set(descriptions)
+        else:
+            sub = vectors[members]
+            keep = {members[int(np.argmax((sub @ sub.T).sum(axis=1)))]}
+        drop.update(i for i in members if i not in keep)
+    return drop
+
+
+def compaction_plan(metadata, vectors: np.ndarray, threshold: float = DEDUP_THRESHOLD):
+    """
+    Decide which rows survive compaction.
+    Returns:
+        tuple[list[int], list[list[int]]]: kept row ids (original order), duplicate clusters
+    """
+    clusters = near_duplicate_clusters(vectors, [m["CPT_Code"] for m in metadata], threshold)
+    drop = select_representatives(clusters, vectors, metadata)
+    return [i for i in range(len(metadata)) if i not in drop], clusters
+
+
+def filter_new_rows(new_vectors: np.ndarray, new_codes, existing_by_code,
+                    threshold: float = DEDUP_THRESHOLD, protect=None):
+    """
+    Ingest-time dedup: drop new rows that duplicate an existing or earlier new row of the same code.
+    Args:
+        new_vectors (np.ndarray): m x dim embeddings of incoming rows
+        new_codes (list[str]): code per incoming row
+        existing_by_code (dict): code -> k x dim embeddings already in the index
+        threshold (float): cosine similarity threshold
+        protect (list[bool]): rows that must be kept regardless (e.g. descriptions)
+    Returns:
+        list[bool]: keep mask for the incoming rows
+    """
+    new_vectors = normalize_embeddings(new_vectors)
+    keep = []
+    accepted = {}
+    for i, code in enumerate(new_codes):
+        pool = [v for v in (existing_by_code.get(code), accepted.get(code)) if v is not None and len(v)]
+        duplicate = bool(pool) and float(np.max(np.vstack(pool) @ new_vectors[i])) >= threshold
+        ok = (protect is not None and protect[i]) or not duplicate
+        keep.append(ok)
+        if ok:
+            prev = accepted.get(code)
+            row = new_vectors[i:i + 1]
+            accepted[code] = row if prev is None else np.vstack([prev, row])
+    return keep
+
+
+def compaction_report(metadata, vectors: np.ndarray, keep_ids, clusters,
+                      threshold: float = DEDUP_THRESHOLD):
+    """
+    Before/after row counts, index size, search latency and retrieval quality of one plan.
+    Args:
+        metadata (list[dict]): row-aligned metadata
+        vectors (np.ndarray): the index vectors the plan was computed from
+        keep_ids / clusters: output of compaction_plan on (metadata, vectors)
+        threshold (float): threshold the plan was computed with
+    Quality is measured on held-out variant queries: "before" searches every other row,
+    "after" searches the rows among those that the plan keeps.
+    """
+    vectors = np.ascontiguousarray(normalize_embeddings(vectors), dtype="float32")
+    corpus_ids, query_ids = holdout_split(metadata)
+    kept = set(keep_ids)
+    after_ids = [i for i in corpus_ids if i in kept]
+    query_vecs = vectors[query_ids]
+    gold = [metadata[i]["CPT_Code"] for i in query_ids]
+
+    config = {"name": "flat", "kind": "flat"}
+    before = evaluate_config(config, vectors[corpus_ids], [metadata[i]["CPT_Code"] for i in corpus_ids],
+                             query_vecs, gold)
+    after = evaluate_config(config, vectors[after_ids], [metadata[i]["CPT_Code"] for i in after_ids],
+                            query_vecs, gold)
+    return {
+        "threshold": threshold,
+        "rows_before": len(metadata),
+        "rows_after": len(keep_ids),
+        "duplicate_clusters": len(clusters),
+        "eval_corpus_rows_before": len(corpus_ids),
+        "eval_corpus_rows_after": len(after_ids),
+        "before": before,
+        "after": after,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compact near-duplicate NL variants")
+    parser.add_argument("--threshold", type=float, default=DEDUP_THRESHOLD)
+    parser.add_argument("--dry-run", action="store_true", help="report only, do not rewrite the KB")
+    parser.add_argument("--report", default=None, help="write the JSON report to this path")
+    args = parser.parse_args()
+
+    from app.updater import CPTUpdater
+
+    updater = CPTUpdater()
+    started = time.perf_counter()
+    vectors = updater.faiss_index.reconstruct_n(0, updater.faiss_index.ntotal)
+    keep_ids, clusters = compaction_plan(updater.metadata, vectors, args.threshold)
+    report = compaction_report(updater.metadata, vectors, keep_ids, clusters, args.threshold)
+    report["report_s"] = round(time.perf_counter() - started, 3)
+
+    print(f"{report['duplicate_clusters']} duplicate clusters: "
+          f"{report['rows_before']} -> {report['rows_after']} rows")
+    for side in ("before", "after"):
+        r = report[side]
+        print(f"{side:<6} eval rows={report[f'eval_corpus_rows_{side}']:<6} index={r['index_bytes'] / 1e6:6.1f}MB "
+              f"p50={r['latency_ms_p50']:.2f}ms R@1={r['recall@1']:.3f} R@5={r['recall@5']:.3f} "
+              f"R@10={r['recall@10']:.3f} MRR={r['mrr@10']:.3f}")
+
+    if not args.dry_run:
+        # Publish the plan reported above, not a recomputation
+        version = updater.compact(args.threshold, plan=(keep_ids, clusters))
+        report["version"] = version
+        print(f"Published version {version['version']}: {version['rows']} rows "
+              f"(-{version['rows_removed']} near-duplicates)")
+
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
 from app.utils import load_metadata
+from app.single_flight import get_flight
 
 # Load metadata once at import
 _metadata = load_metadata()
@@ -22,6 +23,10 @@ def search_by_cpt(cpt_code: str):
     Returns:
         list[str]: list of NL variants, empty if none found
     """
+    # Concurrent lookups of the same code share one metadata reload + scan
+    return list(get_flight("search_by_cpt").do(cpt_code, _search_by_cpt, cpt_code))
+
+def _search_by_cpt(cpt_code: str):
     # Ensure we have the latest metadata
     reload_metadata()
 
@@ -0,0 +1,259 @@
+"""
+Ingest the CMS DHS code list addendum into the knowledge base.
+
+Streams the .xlsx in read-only mode, diffs it against the codes currently in
+metadata, generates NL variants only for new codes, and applies additions,
+deletions and description changes as one batched index/metadata version.
+
+The sheet mixes code rows with INCLUDE / EXCLUDE instructions. Rows listed under
+an EXCLUDE instruction (e.g. the blood component collection codes carved out of
+clinical laboratory) are not DHS codes: they are never added or updated from the
+sheet, but as valid CPT codes the sheet still names, they are not deleted either.
+A series-wide INCLUDE ("all clinical laboratory services in the 80000 series")
+covers codes the sheet never lists, so KB codes in that series are never treated
+as deleted.
+
+Usage (from the repo root):
+    python -m app.dhs_ingest [path.xlsx] [--dry-run] [--keep-deleted]
+"""
+
+import argparse
+import importlib.util
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from openpyxl import load_workbook
+
+from .updater import CPTUpdater
+
+DEFAULT_ADDENDUM = "data/2025_DHS_Code_List_Addendum_11_26_2024.xlsx"
+SYNTHETIC_GEN_SCRIPT = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "generate", "synthetic-data-gen.py"
+)
+VARIANT_WORKERS = int(os.getenv("VARIANT_WORKERS", 8))
+
+# CPT (12345, 0011M, 0791T) and HCPCS Level II (G0027) codes
+_CODE_RE = re.compile(r"[0-9A-Z]\d{3}[0-9A-Z]")
+
+# "... in the 80000 series": every code 80000-89999
+_SERIES_RE = re.compile(r"\b(\d)0000 series\b")
+
+
+# -----------------------
+# Reading
+# -----------------------
+def read_addendum(path: str = DEFAULT_ADDENDUM):
+    """
+    Read the addendum workbook (streamed), applying its INCLUDE / EXCLUDE instructions.
+    Args:
+        path (str): path to the DHS code list .xlsx
+    Returns:
+        dict: "rows": included (code, short description, DHS category heading) tuples,
+              "excluded": codes listed under an EXCLUDE instruction,
+              "series": (low, high) code ranges included wholesale by a series-wide INCLUDE
+    """
+    rows, excluded, series = [], set(), []
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        ws = wb.worksheets[0]
+        category = None
+        excluding = False
+        for row in ws.iter_rows(max_col=2, values_only=True):
+            code, description = (row + (None, None))[:2]
+            if code is None:
+                continue
+            if isinstance(code, (int, float)):
+                code = str(int(code)).zfill(5)  # numeric cells drop leading zeros
+            code = str(code).strip()
+            if _CODE_RE.fullmatch(code):
+                if excluding:
+                    excluded.add(code)
+                else:
+                    rows.append((code, (description or "").strip(), category))
+            elif description is None and code.isupper():
+                category = code  # section heading, e.g. "RADIOLOGY AND CERTAIN OTHER IMAGING SERVICES"
+                excluding = False
+            elif description is None and code.upper().startswith(("INCLUDE", "EXCLUDE")):
+                # "INCLUDE ... in the 80000 series, except EXCLUDE ... the following ..." includes
+                # the series and excludes the codes listed next
+                match = _SERIES_RE.search(code)
+                if match and code.upper().startswith("INCLUDE"):
+                    low = int(match.group(1)) * 10000
+                    series.append((low, low + 9999))
+                excluding = "EXCLUDE" in code.upper()
+            elif description is None and "following" in code.lower():
+                excluding = False  # "The following codes ... are eligible ..." lists
+    finally:
+        wb.close()
+    return {"rows": rows, "excluded": excluded, "series": series}
+
+
+def covered_by_series(code: str, series):
+    """True if a series-wide INCLUDE covers the code."""
+    if not code.isdigit():
+        return False
+    return any(low <= int(code) <= high for low, high in series)
+
+
+# -----------------------
+# Diffing
+# -----------------------
+def current_code_set(metadata):
+    """Map every code in metadata to its formal description (None if it has no description row)."""
+    codes = {}
+    for m in metadata:
+        code = m["CPT_Code"]
+        if m.get("source") == "description":
+            codes[code] = m["text"]
+        else:
+            codes.setdefault(code, None)
+    return codes
+
+
+def diff_code_set(addendum_rows, current, series=(), excluded=()):
+    """
+    Compare addendum rows against the current code set.
+    Args:
+        addendum_rows (iterable[tuple]): included rows from read_addendum
+        current (dict): code -> description, from current_code_set
+        series (list[tuple]): series-wide INCLUDE ranges; KB codes inside them are kept
+        excluded (set): codes listed under an EXCLUDE instruction; kept as they are
+    Returns:
+        tuple[dict, set, dict]: added (code -> description), deleted codes,
+                                changed (code -> new description)
+    """
+    incoming = {}
+    for code, description, _ in addendum_rows:
+        if code not in excluded:
+            incoming.setdefault(code, description)
+
+    added = {c: d for c, d in incoming.items() if c not in current}
+    deleted = {
+        c for c in current
+        if c not in incoming and c not in excluded and not covered_by_series(c, series)
+    }
+    changed = {
+        c: d for c, d in incoming.items()
+        if c in current and current[c] is not None and d and " ".join(d.split()) != " ".join(current[c].split())
+    }
+    return added, deleted, changed
+
+
+# -----------------------
+# Variant generation (new codes only)
+# -----------------------
+def _load_variant_generator():
+    """Reuse generate_nl_variants from generate/synthetic-data-gen.py (not an importable module name)."""
+    spec = importlib.util.spec_from_file_location("synthetic_data_gen", SYNTHETIC_GEN_SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.generate_nl_variants
+
+
+def generate_variants(added, num_variants: int = None):
+    """
+    Generate NL variants for newly added codes, several codes in parallel.
+    Args:
+        added (dict): code -> formal description
+        num_variants (int): variants per code (defaults to the generator's NUM_VARIANTS)
+    Returns:
+        dict: code -> {"formal_description": str, "nl_variants": list[str]}
+    """
+    if not added:
+        return {}
+    generate_nl_variants = _load_variant_generator()
+    kwargs = {"num_variants": num_variants} if num_variants else {}
+
+    def one(item):
+        code, description = item
+        return code, {"formal_description": description,
+                      "nl_variants": generate_nl_variants(description, **kwargs)}
+
+    with ThreadPoolExecutor(max_workers=VARIANT_WORKERS) as pool:
+        return dict(pool.map(one, added.items()))
+
+
+# -----------------------
+# Entry point
+# -----------------------
+def ingest(path: str = DEFAULT_ADDENDUM, dry_run: bool = False, keep_deleted: bool = False,
+           num_variants: int = None, dedup_threshold: float = None):
+    """
+    Diff the addendum against the knowledge base and apply the change set as one version.
+    With dedup_threshold set, near-duplicate generated variants are skipped on ingest.
+    Returns:
+        dict: counts, the applied version record (unless dry_run) and per-phase timings
+    """
+    timings = {}
+
+    started = time.perf_counter()
+    updater = CPTUpdater(dedup_threshold=dedup_threshold)
+    timings["load_kb"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    addendum = read_addendum(path)
+    rows = addendum["rows"]
+    timings["read_addendum"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    added, deleted, changed = diff_code_set(rows, current_code_set(updater.metadata),
+                                            addendum["series"], addendum["excluded"])
+    if keep_deleted:
+        deleted = set()
+    timings["diff"] = time.perf_counter() - started
+
+    report = {
+        "addendum": path,
+        "addendum_codes": len({r[0] for r in rows}),
+        "excluded_codes": sorted(addendum["excluded"]),
+        "series_includes": [f"{low}-{high}" for low, high in addendum["series"]],
+        "added": sorted(added),
+        "deleted": sorted(deleted),
+        "changed": sorted(changed),
+    }
+    if dry_run:
+        report["timings"] = {k: round(v, 3) for k, v in timings.items()}
+        return report
+
+    started = time.perf_counter()
+    added_entries = generate_variants(added, num_variants)
+    timings["generate_variants"] = time.perf_counter() - started
+
+    version = updater.apply_change_set(added_entries, deleted, changed, source=os.path.basename(path))
+    timings.update(version.pop("timings"))
+    report["version"] = version
+    report["timings"] = {k: round(v, 3) for k, v in timings.items()}
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingest the DHS code list addendum")
+    parser.add_argument("path", nargs="?", default=DEFAULT_ADDENDUM)
+    parser.add_argument("--dry-run", action="store_true", help="only report the diff")
+    parser.add_argument("--keep-deleted", action="store_true",
+                        help="do not remove codes that are missing from the addendum")
+    parser.add_argument("--num-variants", type=int, default=None)
+    parser.add_argument("--dedup-threshold", type=float, default=None,
+                        help="skip new variants at least this cosine-similar to one already kept")
+    args = parser.parse_args()
+
+    report = ingest(args.path, args.dry_run, args.keep_deleted, args.num_variants,
+                    args.dedup_threshold)
+    print(f"Addendum codes: {report['addendum_codes']}  Excluded: {len(report['excluded_codes'])}  "
+          f"Series-wide includes: {', '.join(report['series_includes']) or 'none'}")
+    print(f"Added: {len(report['added'])}  Deleted: {len(report['deleted'])}  "
+          f"Changed: {len(report['changed'])}")
+    if report["deleted"]:
+        print(f"Deleted codes: {', '.join(report['deleted'])}")
+    if "version" in report:
+        v = report["version"]
+        print(f"Published version {v['version']}: {v['rows']} rows "
+              f"(+{v['rows_added']} / -{v['rows_removed']})")
+    for phase, seconds in report["timings"].items():
+        print(f"  {phase:<18} {seconds:8.3f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,352 @@
+"""
+Offline retrieval quality + speed evaluation.
+
+Holds out a split of the labelled NL variants in cpt_metadata.json as queries, builds
+indexes from the remaining rows (all descriptions + the other variants), and reports
+recall@1/5/10, MRR and code-level accuracy alongside query latency and memory for each
+index / retrieval configuration. The report is a sorted JSON document, so two runs can
+be diffed directly.
+
+Embeddings come from one of:
+- "index":         vectors already stored in the live KB version's index (row-aligned with metadata)
+- "api":           text-embedding-3 via app.utils.embed_texts, cached on disk by text
+- "deterministic": hashed word/char-trigram vectors; no API, reproducible anywhere
+
+Usage (from the repo root):
+    python -m app.evaluation [--embeddings index|api|deterministic] [--out eval_report.json]
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import platform
+import re
+import time
+
+import faiss
+import numpy as np
+
+from app.utils import load_metadata, load_faiss_index, normalize_embeddings
+from app.two_stage import TwoStageRetriever, shorten_embeddings
+
+HOLDOUT_FRACTION = 0.2
+SEED = 42
+RANK_DEPTH = 50          # rows retrieved per query before collapsing to distinct codes
+ACCURACY_TOP_K = 5       # rows voting for the code-level answer (matches rag_pipeline.TOP_K)
+DETERMINISTIC_DIM = 1536
+EMBEDDING_CACHE = "data/eval_embedding_cache.npz"
+
+# Index / retrieval configurations evaluated by default
+DEFAULT_CONFIGS = [
+    {"name": "flat", "kind": "flat"},
+    {"name": "two_stage_256", "kind": "two_stage", "dim": 256, "rerank_depth": 200},
+    {"name": "two_stage_512", "kind": "two_stage", "dim": 512, "rerank_depth": 200},
+    {"name": "hnsw_m32", "kind": "hnsw", "m": 32, "ef_search": 64},
+    {"name": "ivf_flat", "kind": "ivf", "nlist": 128, "nprobe": 8},
+]
+
+
+# -----------------------
+# Split
+# -----------------------
+def holdout_split(metadata, fraction: float = HOLDOUT_FRACTION, seed: int = SEED):
+    """
+    Per code, hold out a fraction of its variant rows as queries.
+    Descriptions always stay in the corpus; codes with a single variant are not held out.
+    Returns:
+        tuple[list[int], list[int]]: corpus row ids, query row ids (into metadata)
+    """
+    rng = np.random.default_rng(seed)
+    variants_by_code = {}
+    for i, m in enumerate(metadata):
+        if m.get("source") == "variant":
+            variants_by_code.setdefault(m["CPT_Code"], []).append(i)
+
+    held_out = set()
+    for code in sorted(variants_by_code):
+        rows = variants_by_code[code]
+        n = int(round(len(rows) * fraction))
+        if len(rows) >= 2:
+            n = max(1, min(n, len(rows) - 1))
+            held_out.update(rng.choice(rows, n, replace=False).tolist())
+
+    corpus = [i for i in range(len(metadata)) if i not in held_out]
+    return corpus, sorted(held_out)
+
+
+# -----------------------
+# Embeddings
+# -----------------------
+def deterministic_embeddings(texts, dim: int = DETERMINISTIC_DIM):
+    """Hashed bag of words + character trigrams, L2-normalized. Reproducible without an API."""
+    mat = np.zeros((len(texts), dim), dtype="float32")
+    for row, text in enumerate(texts):
+        text = text.lower()
+        features = re.findall(r"[a-z0-9]+", text)
+        padded = f"  {text} "
+        features += [padded[i:i + 3] for i in range(len(padded) - 2)]
+        for feat in features:
+            h = int.from_bytes(hashlib.blake2b(feat.encode("utf-8"), digest_size=8).digest(), "little")
+            mat[row, h % dim] += 1.0 if (h >> 63) & 1 else -1.0
+    return normalize_embeddings(mat)
+
+
+def api_embeddings(texts, cache_path: str = EMBEDDING_CACHE, batch_size: int = 256):
+    """text-embedding-3 embeddings with an on-disk cache keyed by text hash."""
+    from app.utils import embed_texts
+
+    cache = {}
+    if os.path.exists(cache_path):
+        with np.load(cache_path) as data:
+            cache = dict(zip(data["keys"].tolist(), data["vectors"]))
+
+    keys = [hashlib.sha1(t.encode("utf-8")).hexdigest() for t in texts]
+    missing = list(dict.fromkeys(t for t, k in zip(texts, keys) if k not in cache))
+    for i in range(0, len(missing), batch_size):
+        batch = missing[i:i + batch_size]
+        for t, vec in zip(batch, embed_texts(batch)):
+            cache[hashlib.sha1(t.encode("utf-8")).hexdigest()] = vec
+    if missing:
+        np.savez(cache_path, keys=np.array(list(cache)), vectors=np.stack(list(cache.values())))
+    return normalize_embeddings(np.stack([cache[k] for k in keys]))
+
+
+def index_embeddings(n_rows: int, index_path: str = None):
+    """Vectors already in the production flat index (row i <-> metadata row i)."""
+    index = load_faiss_index(index_path)
+    if index.ntotal != n_rows:
+        raise ValueError(f"Index has {index.ntotal} rows but metadata has {n_rows}")
+    return normalize_embeddings(index.reconstruct_n(0, index.ntotal))
+
+
+def load_embeddings(source: str, metadata):
+    texts = [m["text"] for m in metadata]
+    if source == "index":
+        return index_embeddings(len(metadata))
+    if source == "api":
+        return api_embeddings(texts)
+    if source == "deterministic":
+        return deterministic_embeddings(texts)
+    raise ValueError(f"Unknown embedding source: {source}")
+
+
+# -----------------------
+# Index configurations
+# -----------------------
+def build_searcher(config, vectors: np.ndarray):
+    """
+    Build one index configuration over corpus vectors.
+    Returns:
+        tuple[callable, int, int]: search(queries, k) -> row ids, index size in bytes and
+                                   size of the memory-mapped side store in bytes (0 if none)
+    """
+    dim = vectors.shape[1]
+    kind = config["kind"]
+
+    if kind == "flat":
+        index = faiss.IndexFlatL2(dim)
+        index.add(vectors)
+        return (lambda q, k: index.search(q, k)[1]), index.ntotal * dim * 4, 0
+
+    if kind == "two_stage":
+        coarse = faiss.IndexFlatL2(config["dim"])
+        coarse.add(shorten_embeddings(vectors, config["dim"]))
+        retriever = TwoStageRetriever(coarse, vectors, rerank_depth=config["rerank_depth"])
+        # Full vectors are memory-mapped in production and reported separately
+        return ((lambda q, k: retriever.search(q, k)[1]), coarse.ntotal * config["dim"] * 4,
+                vectors.shape[0] * dim * 4)
+
+    if kind == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, config["m"])
+        index.hnsw.efSearch = config["ef_search"]
+        index.add(vectors)
+        return (lambda q, k: index.search(q, k)[1]), faiss.serialize_index(index).nbytes, 0
+
+    if kind == "ivf":
+        quantizer = faiss.IndexFlatL2(dim)
+        index = faiss.IndexIVFFlat(quantizer, dim, min(config["nlist"], vectors.shape[0] // 39))
+        index.train(vectors)
+        index.add(vectors)
+        index.nprobe = config["nprobe"]
+        return (lambda q, k: index.search(q, k)[1]), faiss.serialize_index(index).nbytes, 0
+
+    raise ValueError(f"Unknown index kind: {kind}")
+
+
+# -----------------------
+# Metrics
+# -----------------------
+def _ranked_codes(row_ids, corpus_codes):
+    """Collapse ranked corpus rows to distinct codes, keeping first occurrence order."""
+    return list(dict.fromkeys(corpus_codes[i] for i in row_ids if i >= 0))
+
+
+def _vote(row_ids, corpus_codes, k: int):
+    """Code with most rows among the top-k retrieved rows (ties -> best ranked)."""
+    votes = {}
+    for rank, i in enumerate(row_ids[:k]):
+        if i >= 0:
+            count, best = votes.get(corpus_codes[i], (0, rank))
+            votes[corpus_codes[i]] = (count + 1, best)
+    if not votes:
+        return None
+    return max(votes.items(), key=lambda kv: (kv[1][0], -kv[1][1]))[0]
+
+
+def quality_metrics(all_row_ids, gold_codes, corpus_codes):
+    hits = {1: 0, 5: 0, 10: 0}
+    reciprocal = 0.0
+    correct = 0
+    for row_ids, gold in zip(all_row_ids, gold_codes):
+        ranked = _ranked_codes(row_ids, corpus_codes)
+        for k in hits:
+            hits[k] += gold in ranked[:k]
+        if gold in ranked[:10]:
+            reciprocal += 1.0 / (ranked.index(gold) + 1)
+        correct += _vote(row_ids, corpus_codes, ACCURACY_TOP_K) == gold
+    n = max(1, len(gold_codes))
+    return {
+        "recall@1": round(hits[1] / n, 4),
+        "recall@5": round(hits[5] / n, 4),
+        "recall@10": round(hits[10] / n, 4),
+        "mrr@10": round(reciprocal / n, 4),
+        f"code_accuracy@{ACCURACY_TOP_K}": round(correct / n, 4),
+    }
+
+
+def _rss_anon_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("RssAnon:"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    return None
+
+
+def evaluate_config(config, corpus_vecs, corpus_codes, query_vecs, gold_codes):
+    """Build one configuration, run every query one at a time and in one batch, and score it."""
+    rss_before = _rss_anon_mb()
+    started = time.perf_counter()
+    search, index_bytes, store_bytes = build_searcher(config, corpus_vecs)
+    build_s = time.perf_counter() - started
+    rss_after = _rss_anon_mb()
+
+    latencies = []
+    all_row_ids = []
+    for i in range(query_vecs.shape[0]):
+        started = time.perf_counter()
+        ids = search(query_vecs[i:i + 1], RANK_DEPTH)
+        latencies.append(time.perf_counter() - started)
+        all_row_ids.append(ids[0].tolist())
+
+    started = time.perf_counter()
+    search(query_vecs, RANK_DEPTH)
+    batch_s = time.perf_counter() - started
+
+    lat_ms = np.array(latencies) * 1000
+    return {
+        **quality_metrics(all_row_ids, gold_codes, corpus_codes),
+        "latency_ms_p50": round(float(np.percentile(lat_ms, 50)), 3),
+        "latency_ms_p95": round(float(np.percentile(lat_ms, 95)), 3),
+        "batch_qps": round(query_vecs.shape[0] / batch_s, 1) if batch_s > 0 else None,
+        "build_s": round(build_s, 3),
+        "index_bytes": int(index_bytes),
+        "store_bytes": int(store_bytes),
+        "rss_anon_delta_mb": (round(rss_after - rss_before, 1)
+                              if rss_before is not None and rss_after is not None else None),
+        "config": {k: v for k, v in config.items() if k != "name"},
+    }
+
+
+def run_evaluation(metadata=None, embeddings: str = "index", configs=None,
+                   fraction: float = HOLDOUT_FRACTION, seed: int = SEED, vectors=None):
+    """
+    Run the full evaluation.
+    Args:
+        metadata (list[dict]): row-aligned metadata (defaults to data/cpt_metadata.json)
+        embeddings (str): "index", "api" or "deterministic"
+        configs (list[dict]): index configurations (defaults to DEFAULT_CONFIGS)
+        fraction (float): share of each code's variants held out as queries
+        seed (int): split seed
+        vectors (np.ndarray): precomputed row-aligned vectors (overrides `embeddings`)
+    Returns:
+        dict: JSON-serializable report
+    """
+    metadata = metadata if metadata is not None else load_metadata()
+    configs = configs or DEFAULT_CONFIGS
+
+    started = time.perf_counter()
+    if vectors is None:
+        vectors = load_embeddings(embeddings, metadata)
+    else:
+        embeddings = "precomputed"
+    embed_s = time.perf_counter() - started
+
+    corpus_ids, query_ids = holdout_split(metadata, fraction, seed)
+    corpus_vecs = np.ascontiguousarray(vectors[corpus_ids], dtype="float32")
+    query_vecs = np.ascontiguousarray(vectors[query_ids], dtype="float32")
+    corpus_codes = [metadata[i]["CPT_Code"] for i in corpus_ids]
+    gold_codes = [metadata[i]["CPT_Code"] for i in query_ids]
+
+    results = {
+        config["name"]: evaluate_config(config, corpus_vecs, corpus_codes, query_vecs, gold_codes)
+        for config in configs
+    }
+    return {
+        "dataset": {
+            "rows": len(metadata),
+            "codes": len({m["CPT_Code"] for m in metadata}),
+            "corpus_rows": len(corpus_ids),
+            "queries": len(query_ids),
+            "holdout_fraction": fraction,
+            "seed": seed,
+            "embeddings": embeddings,
+            "dim": int(vectors.shape[1]),
+        },
+        "results": results,
+        "run": {
+            "embed_s": round(embed_s, 3),
+            "faiss": getattr(faiss, "__version__", None),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline retrieval evaluation on held-out variants")
+    parser.add_argument("--embeddings", choices=["index", "api", "deterministic"], default="index")
+    parser.add_argument("--fraction", type=float, default=HOLDOUT_FRACTION)
+    parser.add_argument("--seed", type=int, default=SEED)
+    parser.add_argument("--configs", default=None,
+                        help="comma-separated subset of: " + ",".join(c["name"] for c in DEFAULT_CONFIGS))
+    parser.add_argument("--out", default="eval_report.json")
+    args = parser.parse_args()
+
+    configs = DEFAULT_CONFIGS
+    if args.configs:
+        wanted = set(args.configs.split(","))
+        configs = [c for c in DEFAULT_CONFIGS if c["name"] in wanted]
+
+    report = run_evaluation(embeddings=args.embeddings, configs=configs,
+                            fraction=args.fraction, seed=args.seed)
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+    ds = report["dataset"]
+    print(f"{ds['queries']} held-out queries over {ds['corpus_rows']} corpus rows "
+          f"({ds['codes']} codes, {args.embeddings} embeddings, dim {ds['dim']})")
+    for name, r in report["results"].items():
+        print(f"{name:<14} R@1={r['recall@1']:.3f} R@5={r['recall@5']:.3f} R@10={r['recall@10']:.3f} "
+              f"MRR={r['mrr@10']:.3f} acc@{ACCURACY_TOP_K}={r[f'code_accuracy@{ACCURACY_TOP_K}']:.3f}  "
+              f"p50={r['latency_ms_p50']:.2f}ms p95={r['latency_ms_p95']:.2f}ms  "
+              f"index={r['index_bytes'] / 1e6:.1f}MB"
+              + (f" store={r['store_bytes'] / 1e6:.1f}MB" if r["store_bytes"] else ""))
+    print(f"Report written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
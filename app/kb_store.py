@@ -0,0 +1,166 @@
+"""
+Versioned knowledge-base storage.
+
+Every published version is written to its own directory (data/versions/v<N>/) holding
+the flat index, the row-aligned metadata and, when two-stage retrieval is in use, the
+full-vector store and coarse indexes. Files in a version directory are never modified
+after publish. data/kb_version.json is the manifest naming the live version; it is
+switched with a single os.replace, so:
+
+- a reader that resolves the manifest once gets index, metadata and two-stage files
+  from one version, never index N+1 with metadata N;
+- a crash before the manifest switch leaves the previous version live (the half-written
+  directory is ignored and cleaned up by the next publish);
+- version files and directories are fsynced before the manifest names them, so after a
+  power loss the manifest never points at a missing or truncated version.
+
+Without a manifest (or with one written before versioned storage existed) readers use
+the legacy files directly under data/, which share the same file names.
+Publishing assumes a single writer at a time.
+"""
+
+import json
+import os
+import shutil
+import time
+
+import faiss
+
+from app.two_stage import build_two_stage, existing_coarse_dims
+
+DATA_DIR = "data"
+VERSION_FILE_NAME = "kb_version.json"
+VERSIONS_DIR_NAME = "versions"
+
+INDEX_NAME = "cpt_faiss.index"
+METADATA_NAME = "cpt_metadata.json"
+FULL_VECTORS_NAME = "cpt_embeddings_full.npy"
+COARSE_INDEX_NAME = "cpt_faiss_coarse_{dim}.index"
+
+# Published versions kept on disk; older ones are pruned (open memory maps stay valid)
+KEEP_VERSIONS = int(os.getenv("KB_KEEP_VERSIONS", 3))
+
+
+def read_manifest(data_dir: str = DATA_DIR):
+    """Return the live version record, or {} before anything has been published."""
+    path = os.path.join(data_dir, VERSION_FILE_NAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def kb_paths(version_dir: str):
+    """Paths of the KB files inside one version directory."""
+    return {
+        "index": os.path.join(version_dir, INDEX_NAME),
+        "metadata": os.path.join(version_dir, METADATA_NAME),
+        "full_vectors": os.path.join(version_dir, FULL_VECTORS_NAME),
+        "coarse_template": os.path.join(version_dir, COARSE_INDEX_NAME),
+    }
+
+
+def current_paths(data_dir: str = DATA_DIR):
+    """
+    Resolve the live version once.
+    Returns:
+        dict: version number, its directory and the paths from kb_paths
+    """
+    manifest = read_manifest(data_dir)
+    version_dir = os.path.join(data_dir, manifest["dir"]) if manifest.get("dir") else data_dir
+    return {"version": int(manifest.get("version", 0)), "dir": version_dir, **kb_paths(version_dir)}
+
+
+def publish_version(index, metadata, fields, coarse_dims=(), data_dir: str = DATA_DIR):
+    """
+    Write a complete new version directory, then switch the manifest to it atomically.
+    Args:
+        index (faiss.Index): flat index, row-aligned with metadata
+        metadata (list[dict]): one row per index vector
+        fields (dict): extra fields for the version record (source, row counts, timings...)
+        coarse_dims (list[int]): coarse dimensions to build two-stage artefacts for
+        data_dir (str): knowledge-base root
+    Returns:
+        dict: the published version record
+    """
+    version = int(read_manifest(data_dir).get("version", 0)) + 1
+    versions_root = os.path.join(data_dir, VERSIONS_DIR_NAME)
+    rel_dir = os.path.join(VERSIONS_DIR_NAME, f"v{version}")
+    final_dir = os.path.join(data_dir, rel_dir)
+    staging_dir = f"{final_dir}.tmp"
+
+    # Leftovers of a publish that crashed before its manifest switch
+    for stale in (staging_dir, final_dir):
+        shutil.rmtree(stale, ignore_errors=True)
+    os.makedirs(staging_dir)
+
+    paths = kb_paths(staging_dir)
+    faiss.write_index(index, paths["index"])
+    with open(paths["metadata"], "w", encoding="utf-8") as f:
+        json.dump(metadata, f, indent=2, ensure_ascii=False)
+    if coarse_dims:
+        build_two_stage(index.reconstruct_n(0, index.ntotal), coarse_dims,
+                        full_path=paths["full_vectors"], coarse_template=paths["coarse_template"])
+
+    record = {
+        "version": version,
+        "applied_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        **fields,
+        "rows": len(metadata),
+        "dir": rel_dir,
+    }
+    with open(os.path.join(staging_dir, VERSION_FILE_NAME), "w", encoding="utf-8") as f:
+        json.dump(record, f, indent=2)
+
+    # The version must be on disk before the manifest can name it: file contents, the
+    # staging directory's entries, then the rename into versions/
+    for name in os.listdir(staging_dir):
+        _fsync_file(os.path.join(staging_dir, name))
+    _fsync_dir(staging_dir)
+    os.replace(staging_dir, final_dir)
+    _fsync_dir(versions_root)
+
+    # The switch: readers see either the old manifest or the new one, never a mix
+    manifest = os.path.join(data_dir, VERSION_FILE_NAME)
+    with open(f"{manifest}.tmp", "w", encoding="utf-8") as f:
+        json.dump(record, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(f"{manifest}.tmp", manifest)
+    _fsync_dir(data_dir)
+
+    prune_versions(versions_root, keep_from=version - KEEP_VERSIONS + 1)
+    return record
+
+
+def _fsync_file(path: str):
+    with open(path, "rb") as f:
+        os.fsync(f.fileno())
+
+
+def _fsync_dir(path: str):
+    """Persist a directory's entries (creates and renames); not supported on Windows."""
+    if os.name == "nt":
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def prune_versions(versions_root: str, keep_from: int):
+    """Remove version directories older than `keep_from`."""
+    if not os.path.isdir(versions_root):
+        return
+    for name in os.listdir(versions_root):
+        if name.startswith("v") and name[1:].isdigit() and int(name[1:]) < keep_from:
+            shutil.rmtree(os.path.join(versions_root, name), ignore_errors=True)
+
+
+def current_coarse_dims(data_dir: str = DATA_DIR):
+    """Coarse dimensions built for the live version (empty when two-stage is not in use)."""
+    paths = current_paths(data_dir)
+    if not os.path.exists(paths["full_vectors"]):
+        return []
+    return existing_coarse_dims(paths["coarse_template"])
@@ -0,0 +1,106 @@
+"""
+Dynamic micro-batching across concurrent callers.
+
+Callers submit single items; a background worker collects whatever arrives within a
+short window (or until `max_batch_size` items) and hands the whole batch to one
+`process_batch` call, then fans the results back out to the waiting callers.
+When the batcher is idle (nothing queued, no batch in flight) an item is sent at once,
+so sequential callers never pay the window; batching only kicks in under concurrency.
+"""
+
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class MicroBatcher:
+    """
+    Collect concurrent single-item requests into batches.
+
+    `process_batch(items)` must return a list of results in the same order as `items`.
+    A slot holding an exception instance is raised to that caller only; if
+    `process_batch` itself raises, every caller in that batch receives the exception.
+    """
+
+    def __init__(self,
+                 process_batch,
+                 max_batch_size: int = 64,
+                 max_wait_ms: float = 5.0,
+                 max_inflight_batches: int = 8,
+                 name: str = "micro-batcher"):
+        self.process_batch = process_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+        self.name = name
+        self._queue = queue.Queue()
+        self._worker = None
+        self._lock = threading.Lock()
+        # Batches are processed off the collector thread so the next window can fill meanwhile
+        self._executor = ThreadPoolExecutor(max_workers=max_inflight_batches,
+                                            thread_name_prefix=name)
+        self._inflight = 0
+        self.stats = {"items": 0, "batches": 0, "max_batch": 0}
+
+    def _ensure_worker(self):
+        if self._worker is not None:
+            return
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._collect, name=self.name, daemon=True)
+                self._worker.start()
+
+    def submit(self, item) -> Future:
+        """Queue one item; the returned future resolves to its result."""
+        fut = Future()
+        self._ensure_worker()
+        self._queue.put((item, fut))
+        return fut
+
+    def __call__(self, item):
+        """Submit one item and block until its result is ready."""
+        return self.submit(item).result()
+
+    def _collect(self):
+        while True:
+            batch = [self._queue.get()]
+            with self._lock:
+                busy = self._inflight > 0
+            # Idle and nobody else waiting: don't hold a lone caller for the window
+            window = self.max_wait if busy or not self._queue.empty() else 0.0
+            deadline = time.monotonic() + window
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    if remaining > 0:
+                        batch.append(self._queue.get(timeout=remaining))
+                    else:
+                        # Window closed: still take anything already queued
+                        batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self.stats["items"] += len(batch)
+            self.stats["batches"] += 1
+            self.stats["max_batch"] = max(self.stats["max_batch"], len(batch))
+            with self._lock:
+                self._inflight += 1
+            self._executor.submit(self._dispatch, batch)
+
+    def _dispatch(self, batch):
+        items = [item for item, _ in batch]
+        try:
+            results = self.process_batch(items)
+            if len(results) != len(items):
+                raise RuntimeError(f"{self.name}: expected {len(items)} results, got {len(results)}")
+        except BaseException as e:
+            for _, fut in batch:
+                fut.set_exception(e)
+            return
+        finally:
+            with self._lock:
+                self._inflight -= 1
+        for (_, fut), result in zip(batch, results):
+            if isinstance(result, BaseException):
+                fut.set_exception(result)
+            else:
+                fut.set_result(result)
@@ -1,10 +1,18 @@
-from app.utils import load_faiss_index, load_metadata, embed_text, normalize_embedding
-import numpy as np
+from app.utils import (
+    load_faiss_index, load_metadata, embed_texts, normalize_embeddings,
+)
+import re
 from openai import OpenAI
 import os
 from dotenv import load_dotenv
 import json
-import faiss
+import threading
+
+from app.call_policy import get_policy
+from app.sharded_index import ShardedIndex, parse_code_range
+from app.micro_batcher import MicroBatcher
+from app.two_stage import TwoStageRetriever, RERANK_DEPTH
+from app.kb_store import current_paths
 
 # Load environment variables
 load_dotenv()
@@ -13,35 +21,201 @@ client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 # LLM model for RAG
 RAG_MODEL = "gpt-4o-mini"  # can adjust to gpt-4 or gpt-4.1-mini
 TOP_K = 5  # number of candidates to retrieve from FAISS
+MAX_SEGMENTS = 8  # cap on procedure segments extracted from one note
+
+# Micro-batching of concurrent retrieve_candidates calls (one embed + one matrix search)
+RETRIEVAL_BATCH_MAX_SIZE = int(os.getenv("RETRIEVAL_BATCH_MAX_SIZE", 64))
+RETRIEVAL_BATCH_MAX_WAIT_MS = float(os.getenv("RETRIEVAL_BATCH_MAX_WAIT_MS", 5))
+
+# Retrieval mode: "flat" (full-dimension IndexFlatL2) or "two_stage"
+# (COARSE_DIM coarse index + exact re-rank of RERANK_DEPTH hits on memory-mapped full vectors)
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "flat")
+COARSE_DIM = int(os.getenv("COARSE_DIM", 256))
+
+
+class _LoadedKB:
+    """
+    Metadata + flat index (or two-stage retriever) of one KB version, loaded together.
+    Swapped as one object on reload, so a search never pairs one version's index
+    with another version's metadata.
+    """
+
+    def __init__(self):
+        # Resolve the live version once; every file below comes from that version
+        paths = current_paths()
+        self.version = paths["version"]
+        self.metadata = load_metadata(paths["metadata"])
+        if RETRIEVAL_MODE == "two_stage":
+            self.index = None
+            self.two_stage = TwoStageRetriever.load(
+                COARSE_DIM, metadata=self.metadata, rerank_depth=RERANK_DEPTH,
+                full_path=paths["full_vectors"], coarse_template=paths["coarse_template"],
+            )
+        else:
+            self.index = load_faiss_index(paths["index"])
+            self.two_stage = None
+        # Per-section shards, built once on the first filtered search
+        self._sharded = None
+        self._sharded_lock = threading.Lock()
+
+    def sharded(self):
+        if self._sharded is None:
+            with self._sharded_lock:
+                if self._sharded is None:
+                    self._sharded = ShardedIndex(self.index, self.metadata)
+        return self._sharded
+
+    def search(self, query_embs, top_k: int, code_range=None, sections=None, source=None):
+        """
+        k-NN search over the flat index, or over the routed section shards when any filter is set.
+        Args:
+            query_embs (np.ndarray): n x dim normalized query embeddings
+            top_k (int): neighbors per query
+            code_range: numeric range, e.g. (70000, 79999), "70000-79999" or "992xx"
+            sections (str | list[str]): CPT sections, e.g. "radiology", "pathology", "evaluation_management"
+            source (str | list[str]): metadata source, "description" and/or "variant"
+        Returns:
+            (np.ndarray, np.ndarray): faiss-style distances and metadata row ids
+        """
+        if self.two_stage is not None:
+            return self.two_stage.search(
+                query_embs, top_k,
+                sections=_as_list(sections), sources=_as_list(source), code_range=code_range,
+            )
+        if code_range is None and sections is None and source is None:
+            return self.index.search(query_embs, top_k)
+        return self.sharded().search(
+            query_embs, top_k,
+            sections=_as_list(sections), sources=_as_list(source), code_range=code_range,
+        )
+
+
+def _as_list(value):
+    if value is None or isinstance(value, (list, tuple, set)):
+        return value
+    return [value]
+
 
 # Load FAISS index and metadata once
-_index = load_faiss_index()
-_metadata = load_metadata()
+_kb = _LoadedKB()
+
+
+def reload_index():
+    """
+    Reload index + metadata of the live KB version.
+    Use this after a new version has been published (e.g. by CPTUpdater); searches
+    already running finish on the previous version.
+    """
+    global _kb
+    _kb = _LoadedKB()
 
 
 # -------------------
 # RAG Functions
 # -------------------
 
-def retrieve_candidates(query: str, top_k: int = TOP_K):
+def _chat_completion(prompt: str, timeout: float):
+    """Single chat completion request; retries/hedging are handled by the call policy."""
+    return client.with_options(timeout=timeout, max_retries=0).chat.completions.create(
+        model=RAG_MODEL,
+        messages=[{"role": "user", "content": prompt}],
+        temperature=0
+    )
+
+
+def retrieval_only_suggestion(candidate: dict, reason: str):
+    """
+    Fallback suggestion built from the best retrieved candidate when the LLM is unavailable.
+    Args:
+        candidate (dict): top FAISS candidate
+        reason (str): why generation was skipped
+    Returns:
+        dict: structured suggestion flagged as retrieval-only
+    """
+    return {
+        "CPT_Code": candidate.get("CPT_Code"),
+        "Description": candidate.get("text"),
+        "Reasoning": "LLM unavailable; returning the closest retrieved candidate.",
+        "retrieval_only": True,
+        "fallback_reason": reason,
+    }
+
+
+def retrieve_candidates(query: str, top_k: int = TOP_K,
+                        code_range=None, sections=None, source=None):
     """
     Retrieve top-k CPT candidates from FAISS given a doctor's note.
     Args:
         query (str): natural language doctor's note
         top_k (int): number of nearest neighbors to retrieve
+        code_range: optional code range filter, e.g. "7xxxx", "992xx" or (80000, 89999)
+        sections (str | list[str]): optional CPT section filter
+        source (str | list[str]): optional metadata source filter ("description" / "variant")
     Returns:
         list[dict]: retrieved candidates from metadata
     """
-    query_emb = embed_text(query)
-    query_emb = normalize_embedding(query_emb)
+    # Validate here, in the caller, so a bad filter can't fail other callers' batch
+    filters = _filter_key(code_range, sections, source)
+    return _retrieval_batcher((query, top_k, filters))
+
+
+def _filter_key(code_range=None, sections=None, source=None):
+    """
+    Parsed, hashable (code_range, sections, source) tuple used to group batched searches.
+    Raises:
+        ValueError: unrecognized code range
+    """
+    def freeze(value):
+        value = _as_list(value)
+        return None if value is None else tuple(sorted(str(v) for v in value))
+    return parse_code_range(code_range), freeze(sections), freeze(source)
+
+
+def _retrieve_batch(requests: list):
+    """
+    Serve a micro-batch of retrieve_candidates calls.
+    All distinct queries are embedded in one request, then each filter group runs
+    a single multi-row FAISS search.
+    Args:
+        requests (list[tuple]): (query, top_k, filter_key) per caller
+    Returns:
+        list[list[dict]]: candidates per request, in request order
+    """
+    kb = _kb
+    queries = list(dict.fromkeys(q for q, _, _ in requests))
+    row_of = {q: i for i, q in enumerate(queries)}
+    query_embs = normalize_embeddings(embed_texts(queries))
 
-    # Normalize FAISS index vectors for cosine similarity
-    faiss.normalize_L2(_index.reconstruct_n(0, _index.ntotal))
+    groups = {}
+    for pos, (query, top_k, filters) in enumerate(requests):
+        groups.setdefault(filters, []).append(pos)
 
-    distances, indices = _index.search(query_emb, top_k)
+    results = [None] * len(requests)
+    for filters, positions in groups.items():
+        rows = sorted({row_of[requests[p][0]] for p in positions})
+        k = max(requests[p][1] for p in positions)
+        code_range, sections, source = filters
+        try:
+            _, indices = kb.search(query_embs[rows], k, code_range, sections, source)
+        except Exception as e:
+            # Only this filter group's callers see the failure
+            for p in positions:
+                results[p] = e
+            continue
+        by_row = {r: indices[i] for i, r in enumerate(rows)}
+        for p in positions:
+            query, top_k, _ = requests[p]
+            ids = by_row[row_of[query]][:top_k]
+            results[p] = [kb.metadata[idx] for idx in ids if idx >= 0]
+    return results
 
-    candidates = [_metadata[idx] for idx in indices[0] if idx >= 0]
-    return candidates
+
+_retrieval_batcher = MicroBatcher(
+    _retrieve_batch,
+    max_batch_size=RETRIEVAL_BATCH_MAX_SIZE,
+    max_wait_ms=RETRIEVAL_BATCH_MAX_WAIT_MS,
+    name="retrieval-batcher",
+)
 
 
 def generate_cpt_suggestion(query: str, candidates: list):
@@ -80,11 +254,13 @@ Candidates:
 """
 
     try:
-        response = client.chat.completions.create(
-            model=RAG_MODEL,
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0
-        )
+        response = get_policy("generate").call(_chat_completion, prompt)
+    except Exception as e:
+        # Deadline exceeded, circuit open or upstream error after retries: answer from retrieval alone
+        return retrieval_only_suggestion(candidates[0], str(e))
+
+    text = ""
+    try:
         text = response.choices[0].message.content.strip()
 
         # Try to parse JSON
@@ -95,14 +271,253 @@ Candidates:
 
 
 # Optional: convenience function for full RAG flow
-def rag_query(query: str, top_k: int = TOP_K):
+def rag_query(query: str, top_k: int = TOP_K, **filters):
     """
     Full RAG flow: retrieve + LLM generation.
     Args:
         query (str): doctor's note
         top_k (int): number of FAISS candidates
+        **filters: code_range / sections / source, see retrieve_candidates
     Returns:
         dict: structured output
     """
-    candidates = retrieve_candidates(query, top_k)
+    candidates = retrieve_candidates(query, top_k, **filters)
     return generate_cpt_suggestion(query, candidates)
+
+
+# -------------------
+# Multi-procedure notes
+# -------------------
+
+# Sentence / clause boundaries that always end a segment
+_SENTENCE_SPLIT_RE = re.compile(r"[;\n]+|\.\s+")
+
+# Candidate boundaries inside a sentence: bare commas and coordinating words between procedures.
+# Captured so fragments that turn out not to name a procedure are re-joined verbatim.
+_CLAUSE_SPLIT_RE = re.compile(
+    r"(\s*,\s*(?:(?:and|then)\s+)*|\s+(?:and\s+then|and|then|plus|followed by|as well as|along with|in addition to)\s+)",
+    re.IGNORECASE,
+)
+
+# Connectives left at the start of a segment ("and then CT obtained" -> "CT obtained")
+_LEADING_CONNECTIVE_RE = re.compile(r"^(?:(?:and|then|also|plus|followed by)\b[\s,]*)+", re.IGNORECASE)
+
+# Words naming a billable procedure/service; a clause needs one to stand as its own segment
+_PROCEDURE_CUES = (
+    "ecg", "ekg", "electrocardiogram", "echo", "echocardiogram", "ultrasound", "sonogram",
+    "x-ray", "xray", "radiograph", "ct", "mri", "pet", "scan", "imaging", "mammogram",
+    "fluoroscopy", "panel", "lab", "labs", "test", "assay", "culture", "count", "cbc", "bmp",
+    "cmp", "urinalysis", "biopsy", "excision", "injection", "infusion", "vaccine", "therapy",
+    "visit", "consult", "exam", "examination", "evaluation", "screening", "repair", "removal",
+)
+
+# Words saying a service took place; enough to keep a segment, not to split one off
+_ACTION_CUES = (
+    "performed", "obtained", "done", "ordered", "administered", "completed", "underwent",
+)
+
+
+def _words(text: str):
+    return re.findall(r"[a-z0-9-]+", text.lower())
+
+
+def _names_procedure(text: str) -> bool:
+    return any(w in _PROCEDURE_CUES for w in _words(text))
+
+
+def _split_clauses(sentence: str):
+    """
+    Split one sentence on commas / "and" / "then" between procedure-bearing parts.
+    Fragments that name no procedure ("head and neck", "1,000 units") are merged back
+    into their neighbour, so only boundaries between two procedures survive.
+    """
+    pieces = _CLAUSE_SPLIT_RE.split(sentence)
+    clauses = []
+    for i in range(0, len(pieces), 2):
+        fragment = pieces[i]
+        if clauses and (not _names_procedure(fragment) or not _names_procedure(clauses[-1])):
+            clauses[-1] += pieces[i - 1] + fragment
+        else:
+            clauses.append(fragment)
+    return clauses
+
+
+def split_note_into_segments(note: str, max_segments: int = MAX_SEGMENTS):
+    """
+    Split a clinical note into procedure-bearing segments.
+    Args:
+        note (str): doctor's note, possibly describing several procedures
+        max_segments (int): maximum number of segments to return
+    Returns:
+        list[str]: segments in note order (the whole note if nothing splits out)
+    """
+    segments = []
+    seen = set()
+    for sentence in _SENTENCE_SPLIT_RE.split(note or ""):
+        for part in _split_clauses(sentence):
+            part = _LEADING_CONNECTIVE_RE.sub("", part.strip(" .,:-")).strip(" .,:-")
+            if not part:
+                continue
+            words = _words(part)
+            if not any(w in _PROCEDURE_CUES or w in _ACTION_CUES for w in words):
+                continue
+            key = " ".join(words)
+            if key in seen:
+                continue
+            seen.add(key)
+            segments.append(part)
+            if len(segments) >= max_segments:
+                return segments
+
+    if not segments and note and note.strip():
+        segments = [note.strip()]
+    return segments
+
+
+def retrieve_candidates_batch(queries: list, top_k: int = TOP_K,
+                              code_range=None, sections=None, source=None):
+    """
+    Retrieve top-k CPT candidates for several queries with one embedding call
+    and one multi-row FAISS search.
+    Args:
+        queries (list[str]): query texts
+        top_k (int): number of nearest neighbors per query
+        code_range / sections / source: optional filters, see retrieve_candidates
+    Returns:
+        list[list[dict]]: candidates per query; each candidate carries a cosine "score"
+    """
+    if not queries:
+        return []
+
+    kb = _kb
+    query_embs = normalize_embeddings(embed_texts(queries))
+    distances, indices = kb.search(query_embs, top_k, code_range, sections, source)
+
+    results = []
+    for row_dist, row_idx in zip(distances, indices):
+        row = []
+        for dist, idx in zip(row_dist, row_idx):
+            if idx < 0:
+                continue
+            # Squared L2 between unit vectors -> cosine similarity
+            row.append({**kb.metadata[idx], "score": round(float(1.0 - dist / 2.0), 4)})
+        results.append(row)
+    return results
+
+
+def retrieve_candidates_multi(note: str, top_k: int = TOP_K, **filters):
+    """
+    Decompose a note into procedure segments and retrieve candidates for all of them in one pass.
+    Args:
+        note (str): doctor's note
+        top_k (int): number of candidates per segment
+        **filters: code_range / sections / source, see retrieve_candidates
+    Returns:
+        list[dict]: one entry per segment: {"segment": str, "candidates": list[dict]}
+    """
+    segments = split_note_into_segments(note)
+    per_segment = retrieve_candidates_batch(segments, top_k=top_k, **filters)
+    return [
+        {"segment": seg, "candidates": cands}
+        for seg, cands in zip(segments, per_segment)
+    ]
+
+
+def generate_multi_cpt_suggestions(note: str, segment_candidates: list):
+    """
+    Given a note and per-segment candidates, generate one CPT suggestion per procedure via a single LLM call.
+    Args:
+        note (str): doctor's note
+        segment_candidates (list[dict]): output of retrieve_candidates_multi
+    Returns:
+        list[dict]: structured suggestions (CPT_Code, Description, Reasoning, Segment)
+    """
+    if not any(s["candidates"] for s in segment_candidates):
+        return [{"error": "No candidates retrieved from FAISS"}]
+
+    blocks = []
+    for i, seg in enumerate(segment_candidates, start=1):
+        lines = "\n".join(
+            f"  - CPT {c['CPT_Code']} ({c['source']}): {c['text']}" for c in seg["candidates"]
+        )
+        blocks.append(f'Segment {i}: "{seg["segment"]}"\n{lines}')
+    context_texts = "\n\n".join(blocks)
+
+    prompt = f"""
+You are a medical coding assistant.
+A doctor wrote the following note, which may describe several procedures: "{note}"
+
+The note has been split into segments, each with retrieved CPT candidates.
+For every segment that describes a billable procedure, select the most appropriate CPT code from its candidates.
+Do not repeat the same CPT code twice. Skip segments that do not describe a procedure.
+Format the output as a JSON list like:
+
+[
+  {{
+    "Segment": <segment number>,
+    "CPT_Code": "<code>",
+    "Description": "<formal description / explanation>",
+    "Reasoning": "<why this CPT code fits the segment>"
+  }}
+]
+
+Segments and candidates:
+{context_texts}
+"""
+
+    try:
+        response = get_policy("generate").call(_chat_completion, prompt)
+    except Exception as e:
+        # Deadline exceeded, circuit open or upstream error after retries
+        return [
+            {**retrieval_only_suggestion(s["candidates"][0], str(e)), "Segment": s["segment"]}
+            for s in segment_candidates if s["candidates"]
+        ]
+
+    text = ""
+    try:
+        text = response.choices[0].message.content.strip()
+        if text.startswith("```"):
+            text = text.strip("`")
+            if text.lower().startswith("json"):
+                text = text[4:].lstrip()
+        parsed = json.loads(text)
+        if isinstance(parsed, dict):
+            parsed = [parsed]
+    except Exception as e:
+        return [{"raw_output": text, "error": str(e)}]
+
+    suggestions = []
+    seen_codes = set()
+    for item in parsed:
+        if not isinstance(item, dict):
+            continue
+        code = str(item.get("CPT_Code", "")).strip()
+        if not code or code in seen_codes:
+            continue
+        seen_codes.add(code)
+        try:
+            seg_idx = int(item.get("Segment", 0)) - 1
+        except (TypeError, ValueError):
+            seg_idx = -1
+        # Segment text, or None when the model returned a number outside the segment list
+        item["Segment"] = (
+            segment_candidates[seg_idx]["segment"] if 0 <= seg_idx < len(segment_candidates) else None
+        )
+        item["CPT_Code"] = code
+        suggestions.append(item)
+    return suggestions
+
+
+def multi_rag_query(note: str, top_k: int = TOP_K, **filters):
+    """
+    Multi-procedure RAG flow: decompose note, batched retrieval, single LLM generation.
+    Args:
+        note (str): doctor's note
+        top_k (int): number of FAISS candidates per segment
+        **filters: code_range / sections / source, see retrieve_candidates
+    Returns:
+        list[dict]: one structured suggestion per detected procedure
+    """
+    segment_candidates = retrieve_candidates_multi(note, top_k, **filters)
+    return generate_multi_cpt_suggestions(note, segment_candidates)
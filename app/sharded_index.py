@@ -0,0 +1,190 @@
+"""
+Per-section filtered search over the flat FAISS index.
+
+Rows are grouped into shards keyed by (CPT section, metadata source). A search with
+filters is routed only to the shards that can match, and code ranges that cut through
+a shard narrow it further. The selected rows become one FAISS ID selector bitmap on
+the existing index, so filtered-out vectors are never scored, never take a top-k
+slot, and no vectors are copied: a shard is just a list of row ids.
+"""
+
+import re
+import faiss
+import numpy as np
+
+# Numeric CPT Category I sections (inclusive code ranges)
+CPT_SECTIONS = {
+    "anesthesia": (0, 1999),
+    "surgery": (10000, 69999),
+    "radiology": (70000, 79999),
+    "pathology": (80000, 89999),
+    "evaluation_management": (99202, 99499),
+    "medicine": (90000, 99999),  # checked after evaluation_management
+}
+
+# Alphanumeric code families, keyed by suffix letter
+_SUFFIX_SECTIONS = {
+    "F": "category_ii",
+    "T": "category_iii",
+    "U": "pla",           # proprietary laboratory analyses
+    "M": "multianalyte",  # MAAA
+}
+
+# Friendly aliases accepted by the filters (alias -> sections)
+SECTION_ALIASES = {
+    "lab": ["pathology", "pla", "multianalyte"],
+    "laboratory": ["pathology", "pla", "multianalyte"],
+    "em": ["evaluation_management"],
+    "e/m": ["evaluation_management"],
+    "imaging": ["radiology"],
+}
+
+
+def cpt_section(code: str) -> str:
+    """
+    Map a CPT/HCPCS code to its section name.
+    Args:
+        code (str): code such as "76700", "0011M" or "G0027"
+    Returns:
+        str: section name (see CPT_SECTIONS / _SUFFIX_SECTIONS), "hcpcs" or "unknown"
+    """
+    code = str(code).strip().upper()
+    if code.isdigit():
+        n = int(code)
+        for name, (low, high) in CPT_SECTIONS.items():
+            if low <= n <= high:
+                return name
+        return "unknown"
+    if code[:1].isalpha():
+        return "hcpcs"
+    return _SUFFIX_SECTIONS.get(code[-1:], "unknown")
+
+
+def parse_code_range(spec):
+    """
+    Parse a code range filter.
+    Args:
+        spec: (low, high) tuple, "70000-79999", or a wildcard pattern like "7xxxx" / "992xx"
+    Returns:
+        tuple[int, int] | None: inclusive numeric range
+    """
+    if spec is None:
+        return None
+    if isinstance(spec, (tuple, list)):
+        low, high = spec
+        return int(low), int(high)
+    spec = str(spec).strip().lower()
+    if "-" in spec:
+        low, high = spec.split("-", 1)
+        return int(low), int(high)
+    if re.fullmatch(r"\d*x+", spec) and len(spec) == 5:
+        return int(spec.replace("x", "0")), int(spec.replace("x", "9"))
+    if spec.isdigit():
+        return int(spec), int(spec)
+    raise ValueError(f"Unrecognized code range: {spec!r}")
+
+
+def _code_number(code: str) -> int:
+    code = str(code).strip()
+    return int(code) if code.isdigit() else -1
+
+
+class ShardedIndex:
+    """Section/source shards (row-id lists) over a flat index and its row-aligned metadata."""
+
+    def __init__(self, index, metadata: list):
+        keys = [
+            (cpt_section(m.get("CPT_Code", "")), m.get("source", "variant"))
+            for m in metadata[:index.ntotal]
+        ]
+        numbers = np.array([_code_number(m.get("CPT_Code", "")) for m in metadata[:index.ntotal]],
+                           dtype="int64")
+
+        self.index = index
+        self.dim = index.d
+        self.shards = {}
+        rows_by_key = {}
+        for i, key in enumerate(keys):
+            rows_by_key.setdefault(key, []).append(i)
+        for key in sorted(rows_by_key):
+            ids = np.array(rows_by_key[key], dtype="int64")
+            codes = numbers[ids]
+            numeric = codes[codes >= 0]
+            self.shards[key] = {
+                "ids": ids,  # global row ids
+                "codes": codes,
+                "min_code": int(numeric.min()) if numeric.size else None,
+                "max_code": int(numeric.max()) if numeric.size else None,
+            }
+
+    def route(self, sections=None, sources=None, code_range=None):
+        """
+        Pick the shards that can satisfy the filters.
+        Args:
+            sections (list[str] | None): section names/aliases
+            sources (list[str] | None): metadata sources ("description", "variant")
+            code_range (tuple[int, int] | None): inclusive numeric range
+        Returns:
+            list[tuple]: shard keys to search
+        """
+        if sections is not None:
+            sections = {
+                name for s in sections for name in SECTION_ALIASES.get(s.lower(), [s.lower()])
+            }
+        if sources is not None:
+            sources = set(sources)
+
+        routed = []
+        for key, shard in self.shards.items():
+            section, source = key
+            if sections is not None and section not in sections:
+                continue
+            if sources is not None and source not in sources:
+                continue
+            if code_range is not None:
+                if shard["min_code"] is None:
+                    continue
+                if shard["max_code"] < code_range[0] or shard["min_code"] > code_range[1]:
+                    continue
+            routed.append(key)
+        return routed
+
+    def search(self, query_embs: np.ndarray, top_k: int,
+               sections=None, sources=None, code_range=None):
+        """
+        Filtered k-NN search across the routed shards.
+        Returns:
+            (np.ndarray, np.ndarray): distances and global row ids, shaped like faiss output
+                                      (rows padded with -1 when fewer than top_k match)
+        """
+        code_range = parse_code_range(code_range)
+        n = query_embs.shape[0]
+        ntotal = self.index.ntotal
+
+        mask = np.zeros(ntotal, dtype=bool)
+        for key in self.route(sections, sources, code_range):
+            shard = self.shards[key]
+            ids = shard["ids"]
+            if code_range is not None and not (
+                code_range[0] <= shard["min_code"] and shard["max_code"] <= code_range[1]
+            ):
+                # Range cuts through this shard: keep only its rows inside the range
+                codes = shard["codes"]
+                ids = ids[(codes >= code_range[0]) & (codes <= code_range[1])]
+            mask[ids] = True
+
+        distances = np.full((n, top_k), np.inf, dtype="float32")
+        indices = np.full((n, top_k), -1, dtype="int64")
+        selected = int(mask.sum())
+        if selected == 0:
+            return distances, indices
+        if selected == ntotal:
+            return self.index.search(query_embs, top_k)
+
+        # Bit i of the bitmap (little-endian within each byte) selects row i
+        bitmap = np.packbits(mask, bitorder="little")
+        params = faiss.SearchParameters(sel=faiss.IDSelectorBitmap(ntotal, faiss.swig_ptr(bitmap)))
+        dist, ids = self.index.search(query_embs, top_k, params=params)
+        distances[:] = np.where(ids >= 0, dist, np.inf)
+        indices[:] = ids
+        return distances, indices
@@ -0,0 +1,141 @@
+"""
+Single-flight request coalescing.
+
+Concurrent calls with the same key share one in-flight computation: the first caller
+(the leader) runs the function, everyone else waits for and receives its result.
+Works for threads (`do`) and asyncio tasks (`do_async`); async leaders go through the
+thread path, so a thread and a task asking for the same key also share one call.
+"""
+
+import asyncio
+import threading
+import weakref
+
+
+def normalize_key(text: str) -> str:
+    """Case/whitespace-insensitive key for free-text inputs such as notes."""
+    return " ".join((text or "").lower().split())
+
+
+class _Call:
+    __slots__ = ("event", "result", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class _AsyncCall:
+    __slots__ = ("future", "waiters")
+
+    def __init__(self, future):
+        self.future = future
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Coalesce concurrent calls that share a key."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._calls = {}
+        self._lock = threading.Lock()
+        # Per event loop: key -> asyncio.Future shared by tasks on that loop
+        self._async_calls = weakref.WeakKeyDictionary()
+        self.stats = {"calls": 0, "executions": 0, "saved": 0}
+
+    def _bump(self, key: str):
+        with self._lock:
+            self.stats[key] += 1
+
+    def do(self, key, fn, *args, **kwargs):
+        """
+        Run `fn(*args, **kwargs)` once per in-flight key.
+        Args:
+            key: hashable identity of the request
+            fn (callable): computation to run if no identical call is in flight
+        Returns:
+            result of the shared computation (the same object for every caller)
+        """
+        with self._lock:
+            self.stats["calls"] += 1
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+                self.stats["executions"] += 1
+            else:
+                self.stats["saved"] += 1
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.event.set()
+        return call.result
+
+    async def do_async(self, key, fn, *args, **kwargs):
+        """
+        Asyncio variant of `do`; `fn` is a regular (blocking) callable run in the default executor.
+        The shared future is the executor's, so cancelling any one waiter (including the task
+        that started the call) leaves the others waiting; it is only cancelled once nobody is.
+        """
+        loop = asyncio.get_running_loop()
+        flights = self._async_calls.setdefault(loop, {})
+        call = flights.get(key)
+        if call is None:
+            call = _AsyncCall(loop.run_in_executor(None, lambda: self.do(key, fn, *args, **kwargs)))
+            flights[key] = call
+            call.future.add_done_callback(lambda fut: self._finish_async(flights, key, call))
+        else:
+            self._bump("calls")
+            self._bump("saved")
+
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.future)
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.future.done():
+                # Every waiter gave up; a thread already running fn finishes unobserved
+                call.future.cancel()
+
+    @staticmethod
+    def _finish_async(flights, key, call):
+        if flights.get(key) is call:
+            del flights[key]
+        if not call.future.cancelled():
+            # Mark retrieved so failures without waiters don't log warnings
+            call.future.exception()
+
+
+# -----------------------
+# Registry
+# -----------------------
+
+_FLIGHTS = {}
+
+
+def get_flight(name: str) -> SingleFlight:
+    """Return the shared coalescer for a call site, creating it on first use."""
+    flight = _FLIGHTS.get(name)
+    if flight is None:
+        flight = _FLIGHTS.setdefault(name, SingleFlight(name))
+    return flight
+
+
+def coalescing_stats():
+    """Calls, actual executions and calls saved by coalescing, per call site."""
+    return {name: dict(f.stats) for name, f in _FLIGHTS.items()}
@@ -0,0 +1,162 @@
+"""
+Two-stage retrieval: reduced-dimension coarse search + full-dimension exact re-rank.
+
+text-embedding-3 vectors can be shortened by keeping the leading dimensions and
+re-normalizing (equivalent to the API's `dimensions` parameter). The coarse index
+holds those short vectors; the full 1536-d vectors live in a .npy side store that is
+memory-mapped, so only the rows touched by re-ranking are paged in. Both files belong
+to a KB version directory (see app/kb_store.py).
+"""
+
+import os
+import glob
+import re
+import threading
+import faiss
+import numpy as np
+
+from app.sharded_index import ShardedIndex
+
+# Candidates taken from the coarse index for exact re-ranking
+RERANK_DEPTH = 200
+
+
+def shorten_embeddings(mat: np.ndarray, dim: int) -> np.ndarray:
+    """
+    Shorten embeddings to their first `dim` dimensions and re-normalize.
+    Args:
+        mat (np.ndarray): n x full_dim embeddings
+        dim (int): target dimension (e.g. 256 or 512)
+    Returns:
+        np.ndarray: n x dim float32 unit vectors
+    """
+    short = np.ascontiguousarray(np.asarray(mat, dtype="float32")[:, :dim])
+    faiss.normalize_L2(short)
+    return short
+
+
+def build_two_stage(vectors: np.ndarray, dims, full_path: str, coarse_template: str):
+    """
+    Write the full-dimension side store and one coarse flat index per dimension.
+    Args:
+        vectors (np.ndarray): n x full_dim embeddings, row-aligned with metadata
+        dims (list[int]): coarse dimensions to build
+        full_path (str): .npy file for full vectors
+        coarse_template (str): path template with a {dim} placeholder
+    """
+    full = np.ascontiguousarray(np.asarray(vectors, dtype="float32"))
+    faiss.normalize_L2(full)
+    os.makedirs(os.path.dirname(full_path) or ".", exist_ok=True)
+
+    # Write everything to temp files first, then rename into place: a live reader keeps
+    # its memory map of the old (unlinked) inode instead of seeing a file rewritten under it
+    staged = {}
+    tmp = f"{full_path}.tmp"
+    with open(tmp, "wb") as f:
+        np.save(f, full)
+    staged[tmp] = full_path
+    for dim in dims:
+        coarse = faiss.IndexFlatL2(dim)
+        coarse.add(shorten_embeddings(full, dim))
+        path = coarse_template.format(dim=dim)
+        faiss.write_index(coarse, f"{path}.tmp")
+        staged[f"{path}.tmp"] = path
+    for tmp, path in staged.items():
+        os.replace(tmp, path)
+
+
+def existing_coarse_dims(coarse_template: str):
+    """Dimensions for which a coarse index file is present on disk."""
+    pattern = re.escape(coarse_template).replace(re.escape("{dim}"), r"(\d+)")
+    dims = []
+    for path in glob.glob(coarse_template.format(dim="*")):
+        match = re.fullmatch(pattern, path)
+        if match:
+            dims.append(int(match.group(1)))
+    return sorted(dims)
+
+
+class TwoStageRetriever:
+    """Coarse k-NN over shortened vectors, then exact re-rank against full vectors."""
+
+    def __init__(self, coarse_index, full_vectors: np.ndarray, metadata: list = None,
+                 rerank_depth: int = RERANK_DEPTH):
+        if coarse_index.ntotal != full_vectors.shape[0]:
+            raise ValueError(
+                f"Coarse index has {coarse_index.ntotal} rows but full store has {full_vectors.shape[0]}"
+            )
+        self.coarse = coarse_index
+        self.full = full_vectors
+        self.dim = coarse_index.d
+        self.metadata = metadata
+        self.rerank_depth = rerank_depth
+        self._sharded = None
+        self._sharded_lock = threading.Lock()
+
+    @classmethod
+    def load(cls, dim: int, metadata: list = None, rerank_depth: int = RERANK_DEPTH,
+             full_path: str = None, coarse_template: str = None):
+        """
+        Load the coarse index and memory-map the full-dimension store.
+        Paths default to the live KB version's files.
+        """
+        if full_path is None or coarse_template is None:
+            from app.kb_store import current_paths  # kb_store builds on this module
+
+            paths = current_paths()
+            full_path = full_path or paths["full_vectors"]
+            coarse_template = coarse_template or paths["coarse_template"]
+        coarse_path = coarse_template.format(dim=dim)
+        for path in (coarse_path, full_path):
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"Two-stage artefact not found: {path}")
+        coarse = faiss.read_index(coarse_path)
+        full = np.load(full_path, mmap_mode="r")
+        return cls(coarse, full, metadata=metadata, rerank_depth=rerank_depth)
+
+    def _coarse_search(self, short_q, depth, sections=None, sources=None, code_range=None):
+        if sections is None and sources is None and code_range is None:
+            return self.coarse.search(short_q, depth)
+        if self.metadata is None:
+            raise ValueError("Filtered two-stage search needs metadata")
+        if self._sharded is None:
+            with self._sharded_lock:
+                if self._sharded is None:
+                    self._sharded = ShardedIndex(self.coarse, self.metadata)
+        return self._sharded.search(short_q, depth, sections=sections, sources=sources,
+                                    code_range=code_range)
+
+    def search(self, query_embs: np.ndarray, top_k: int, rerank_depth: int = None,
+               sections=None, sources=None, code_range=None):
+        """
+        Two-stage k-NN search.
+        Args:
+            query_embs (np.ndarray): n x full_dim normalized query embeddings
+            top_k (int): neighbors to return per query
+            rerank_depth (int): coarse candidates re-ranked per query
+            sections / sources / code_range: optional filters, see ShardedIndex.search
+        Returns:
+            (np.ndarray, np.ndarray): squared L2 distances on full vectors and row ids
+        """
+        depth = max(top_k, rerank_depth or self.rerank_depth)
+        short_q = shorten_embeddings(query_embs, self.dim)
+        _, coarse_ids = self._coarse_search(short_q, depth, sections, sources, code_range)
+
+        n = query_embs.shape[0]
+        distances = np.full((n, top_k), np.inf, dtype="float32")
+        indices = np.full((n, top_k), -1, dtype="int64")
+        for row in range(n):
+            ids = coarse_ids[row]
+            ids = np.unique(ids[ids >= 0])  # sorted -> sequential reads from the memmap
+            if ids.size == 0:
+                continue
+            full = np.asarray(self.full[ids], dtype="float32")
+            q = np.asarray(query_embs[row], dtype="float32")
+            # Unit vectors: squared L2 = 2 - 2 * cosine
+            dist = 2.0 - 2.0 * (full @ q)
+            k = min(top_k, ids.size)
+            best = np.argpartition(dist, k - 1)[:k]
+            best = best[np.argsort(dist[best])]
+            distances[row, :k] = dist[best]
+            indices[row, :k] = ids[best]
+        return distances, indices
@@ -1,34 +1,40 @@
 import json
+import time
 import numpy as np
+import faiss
 from pathlib import Path
-from .utils import embed_text, load_faiss_index, save_faiss_index, normalize_embedding
+from .utils import embed_texts, load_faiss_index, normalize_embeddings, flatten_legacy_metadata
+from .kb_store import current_paths, current_coarse_dims, publish_version
+from .compaction import compaction_plan, filter_new_rows, DEDUP_THRESHOLD
 
-# -----------------------
-# Paths
-# -----------------------
-METADATA_FILE = Path("data/cpt_metadata.json")
-FAISS_INDEX_FILE = Path("data/cpt_faiss.index")
+# Texts per embeddings request when applying a change set
+EMBED_BATCH_SIZE = 256
 
 # -----------------------
 # Load existing data
 # -----------------------
-def load_metadata():
-    if METADATA_FILE.exists():
-        with open(METADATA_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
+def load_metadata(path):
+    if Path(path).exists():
+        with open(path, "r", encoding="utf-8") as f:
+            return flatten_legacy_metadata(json.load(f))
     return []
 
-def save_metadata(metadata):
-    with open(METADATA_FILE, "w", encoding="utf-8") as f:
-        json.dump(metadata, f, indent=2, ensure_ascii=False)
-
 # -----------------------
 # Main Updater Class
 # -----------------------
 class CPTUpdater:
-    def __init__(self):
-        self.metadata = load_metadata()
-        self.faiss_index = load_faiss_index()  # Assumes utils.py has a load function
+    def __init__(self, dedup_threshold=None):
+        """
+        Args:
+            dedup_threshold (float | None): if set, new variants whose cosine similarity to an
+                existing (or earlier new) row of the same code reaches this value are skipped
+        """
+        # Index and metadata of the live KB version (see app/kb_store.py)
+        paths = current_paths()
+        self.version = paths["version"]
+        self.metadata = load_metadata(paths["metadata"])
+        self.faiss_index = load_faiss_index(paths["index"])
+        self.dedup_threshold = dedup_threshold
 
     # -----------------------
     # Add new CPT code with variants
@@ -45,19 +51,18 @@ class CPTUpdater:
         # Normalize and deduplicate NL variants
         nl_variants = list({v.strip() for v in nl_variants if v.strip()})
 
-        # Append to metadata
-        new_entry = {
+        # Rows in the same layout as generate/build_faiss_index.py
+        new_rows = [{"CPT_Code": cpt_code, "source": "description", "text": formal_description}]
+        new_rows += [{"CPT_Code": cpt_code, "source": "variant", "text": v} for v in nl_variants]
+
+        # Embed, optionally dedup, then append to metadata + FAISS
+        added = self._add_rows(new_rows)
+
+        return {
             "CPT_Code": cpt_code,
             "formal_description": formal_description,
-            "nl_variants": nl_variants
+            "nl_variants": [r["text"] for r in added if r["source"] == "variant"]
         }
-        self.metadata.append(new_entry)
-        save_metadata(self.metadata)
-
-        # Add embeddings to FAISS
-        self._add_to_faiss(nl_variants, cpt_code)
-
-        return new_entry
 
     # -----------------------
     # Add NL variants to existing CPT code
@@ -66,32 +71,200 @@ class CPTUpdater:
         """
         Add new NL variants for an existing CPT code
         """
-        entry = next((m for m in self.metadata if m["CPT_Code"] == cpt_code), None)
-        if not entry:
+        rows = [m for m in self.metadata if m["CPT_Code"] == cpt_code]
+        if not rows:
             raise ValueError(f"CPT {cpt_code} does not exist. Use add_new_cpt instead.")
 
         # Normalize and deduplicate
         new_variants = list({v.strip() for v in new_variants if v.strip()})
-        existing_set = set(entry["nl_variants"])
+        existing_set = {m["text"] for m in rows if m.get("source") == "variant"}
         variants_to_add = [v for v in new_variants if v not in existing_set]
-        if not variants_to_add:
-            return entry  # Nothing to add
+        if variants_to_add:
+            # Embed, optionally dedup, then append to metadata + FAISS
+            added = self._add_rows(
+                [{"CPT_Code": cpt_code, "source": "variant", "text": v} for v in variants_to_add]
+            )
+            variants_to_add = [r["text"] for r in added]
+
+        return {
+            "CPT_Code": cpt_code,
+            "nl_variants": sorted(existing_set) + variants_to_add
+        }
+
+    # -----------------------
+    # Apply a batch of additions / deletions / changes as one version
+    # -----------------------
+    def apply_change_set(self, added=None, deleted=None, changed=None, source=None):
+        """
+        Apply a whole change set and publish it as a single new index/metadata version.
+
+        Args:
+            added (dict): code -> {"formal_description": str, "nl_variants": list[str]}
+            deleted (iterable[str]): codes to remove (all of their rows)
+            changed (dict): code -> new formal description (replaces the description row;
+                            existing variants are kept)
+            source (str): where the change set came from, recorded in the version file
+        Returns:
+            dict: version record with row counts and per-phase timings (seconds)
+        """
+        added = added or {}
+        deleted = set(deleted or [])
+        changed = changed or {}
+        timings = {}
+        old_rows = len(self.metadata)
+
+        # Rows to keep, in their current order
+        started = time.perf_counter()
+        keep_ids = [
+            i for i, m in enumerate(self.metadata)
+            if m["CPT_Code"] not in deleted
+            and not (m["CPT_Code"] in changed and m.get("source") == "description")
+        ]
+        kept_vectors = (
+            self.faiss_index.reconstruct_batch(np.array(keep_ids, dtype="int64"))
+            if keep_ids else np.zeros((0, self.faiss_index.d), dtype="float32")
+        )
+        new_metadata = [self.metadata[i] for i in keep_ids]
 
-        # Update metadata
-        entry["nl_variants"].extend(variants_to_add)
-        save_metadata(self.metadata)
+        # New rows: changed descriptions + added codes (description + variants)
+        new_rows = [
+            {"CPT_Code": code, "source": "description", "text": desc}
+            for code, desc in changed.items()
+        ]
+        for code, entry in added.items():
+            new_rows.append({"CPT_Code": code, "source": "description",
+                             "text": entry["formal_description"]})
+            variants = list(dict.fromkeys(v.strip() for v in entry.get("nl_variants", []) if v.strip()))
+            new_rows += [{"CPT_Code": code, "source": "variant", "text": v} for v in variants]
+        timings["diff_rows"] = time.perf_counter() - started
 
-        # Add embeddings to FAISS
-        self._add_to_faiss(variants_to_add, cpt_code)
+        # Batched embeddings for the new rows only
+        started = time.perf_counter()
+        texts = [r["text"] for r in new_rows]
+        chunks = [
+            normalize_embeddings(embed_texts(texts[i:i + EMBED_BATCH_SIZE]))
+            for i in range(0, len(texts), EMBED_BATCH_SIZE)
+        ]
+        new_vectors = np.vstack(chunks) if chunks else np.zeros((0, self.faiss_index.d), dtype="float32")
+        timings["embed"] = time.perf_counter() - started
 
-        return entry
+        if self.dedup_threshold is not None and new_rows:
+            started = time.perf_counter()
+            keep = self._dedup_mask(new_rows, new_vectors, keep_ids)
+            new_rows = [r for r, k in zip(new_rows, keep) if k]
+            new_vectors = new_vectors[np.array(keep, dtype=bool)]
+            timings["dedup"] = time.perf_counter() - started
+
+        # Build the new index
+        started = time.perf_counter()
+        index = faiss.IndexFlatL2(self.faiss_index.d)
+        index.add(np.ascontiguousarray(np.vstack([kept_vectors, new_vectors]), dtype="float32"))
+        new_metadata += new_rows
+        timings["build_index"] = time.perf_counter() - started
+
+        return self._publish(index, new_metadata, timings, {
+            "source": source,
+            "added_codes": len(added),
+            "deleted_codes": len(deleted),
+            "changed_codes": len(changed),
+            "rows_removed": old_rows - len(keep_ids),
+            "rows_added": len(new_rows),
+        })
+
+    # -----------------------
+    # Remove near-duplicate variants as one version
+    # -----------------------
+    def compact(self, threshold=None, plan=None):
+        """
+        Drop same-code near-duplicate variants (see app/compaction.py) and publish
+        the compacted index + metadata as one version.
+        Args:
+            threshold (float): cosine similarity threshold
+            plan (tuple): (keep_ids, clusters) from compaction_plan on this updater's
+                metadata and index vectors; computed here if omitted
+        """
+        threshold = threshold if threshold is not None else (self.dedup_threshold or DEDUP_THRESHOLD)
+        timings = {}
+
+        started = time.perf_counter()
+        vectors = self.faiss_index.reconstruct_n(0, self.faiss_index.ntotal)
+        if plan is None:
+            plan = compaction_plan(self.metadata, vectors, threshold)
+        keep_ids, clusters = plan
+        timings["cluster"] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        index = faiss.IndexFlatL2(self.faiss_index.d)
+        index.add(np.ascontiguousarray(vectors[keep_ids]))
+        timings["build_index"] = time.perf_counter() - started
+
+        old_rows = len(self.metadata)
+        return self._publish(index, [self.metadata[i] for i in keep_ids], timings, {
+            "source": f"compaction@{threshold}",
+            "duplicate_clusters": len(clusters),
+            "rows_removed": old_rows - len(keep_ids),
+            "rows_added": 0,
+        })
+
+    def _publish(self, index, metadata, timings, fields):
+        """
+        Publish index + metadata (+ two-stage artefacts, if the live version has them) as a
+        new version directory and switch the manifest to it in one atomic rename.
+        """
+        started = time.perf_counter()
+        record = publish_version(index, metadata, {
+            **fields,
+            "timings": {k: round(v, 3) for k, v in timings.items()},
+        }, coarse_dims=current_coarse_dims())
+        self.version = record["version"]
+        self.faiss_index = index
+        self.metadata = metadata
+        timings["publish"] = time.perf_counter() - started
+        return {**record, "timings": {k: round(v, 3) for k, v in timings.items()}}
 
     # -----------------------
-    # Internal: add embeddings to FAISS
+    # Internal: ingest-time dedup
     # -----------------------
-    def _add_to_faiss(self, texts, cpt_code):
-        vectors = [normalize_embedding(embed_text(t)) for t in texts]
-        # FAISS index expects a 2D numpy array
-        vectors_array = np.array(vectors).astype("float32")
-        self.faiss_index.add(vectors_array)
-        save_faiss_index(self.faiss_index)
+    def _dedup_mask(self, new_rows, new_vectors, existing_ids=None):
+        """Keep mask for new rows; descriptions are always kept."""
+        codes = {r["CPT_Code"] for r in new_rows}
+        if existing_ids is None:
+            existing_ids = range(len(self.metadata))
+        existing = {}
+        for i in existing_ids:
+            code = self.metadata[i]["CPT_Code"]
+            if code in codes:
+                existing.setdefault(code, []).append(i)
+        existing_by_code = {
+            code: normalize_embeddings(self.faiss_index.reconstruct_batch(np.array(ids, dtype="int64")))
+            for code, ids in existing.items()
+        }
+        return filter_new_rows(
+            new_vectors, [r["CPT_Code"] for r in new_rows], existing_by_code, self.dedup_threshold,
+            protect=[r["source"] == "description" for r in new_rows],
+        )
+
+    # -----------------------
+    # Internal: add rows to metadata + FAISS
+    # -----------------------
+    def _add_rows(self, rows):
+        # One batched embeddings request; FAISS index expects a 2D float32 array
+        vectors_array = normalize_embeddings(embed_texts([r["text"] for r in rows])).astype("float32")
+        if self.dedup_threshold is not None:
+            keep = self._dedup_mask(rows, vectors_array)
+            rows = [r for r, k in zip(rows, keep) if k]
+            vectors_array = vectors_array[np.array(keep, dtype=bool)]
+        if not rows:
+            return rows
+
+        # New index object: the live version's files (and anyone reading them) stay untouched
+        index = faiss.IndexFlatL2(self.faiss_index.d)
+        index.add(np.ascontiguousarray(np.vstack([
+            self.faiss_index.reconstruct_n(0, self.faiss_index.ntotal), vectors_array,
+        ])))
+        self._publish(index, self.metadata + rows, {}, {
+            "source": "add_rows",
+            "rows_removed": 0,
+            "rows_added": len(rows),
+        })
+        return rows
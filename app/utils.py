@@ -5,55 +5,83 @@ import numpy as np
 from openai import OpenAI
 from dotenv import load_dotenv
 
+from app.call_policy import get_policy
+from app.single_flight import get_flight
+from app.micro_batcher import MicroBatcher
+from app.kb_store import current_paths
+
 # Load environment variables from .env
 load_dotenv()
 
 # Initialize OpenAI client
 client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
-# Paths to FAISS index and metadata
-FAISS_INDEX_FILE = "data/cpt_faiss.index"
-METADATA_FILE = "data/cpt_metadata.json"
-
 # Embedding model to use
 EMBED_MODEL = "text-embedding-3-small"
 
+# Micro-batching of concurrent embed_text calls (one API request per window)
+EMBED_BATCH_MAX_SIZE = int(os.getenv("EMBED_BATCH_MAX_SIZE", 128))
+EMBED_BATCH_MAX_WAIT_MS = float(os.getenv("EMBED_BATCH_MAX_WAIT_MS", 5))
+
 # -------------------
 # Utility functions
 # -------------------
 
-def load_faiss_index():
+def load_faiss_index(path: str = None):
     """
     Load the FAISS index from file.
+    Args:
+        path (str): index file (defaults to the live KB version's index)
     Returns:
         faiss.Index: loaded FAISS index
     """
-    if not os.path.exists(FAISS_INDEX_FILE):
-        raise FileNotFoundError(f"FAISS index file not found: {FAISS_INDEX_FILE}")
-    index = faiss.read_index(FAISS_INDEX_FILE)
+    path = path or current_paths()["index"]
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"FAISS index file not found: {path}")
+    index = faiss.read_index(path)
     return index
 
-def save_faiss_index(index):
+
+def load_metadata(path: str = None):
     """
-    Save the FAISS index to file.
+    Load CPT metadata JSON.
     Args:
-        index (faiss.Index): FAISS index to save
+        path (str): metadata file (defaults to the live KB version's metadata)
+    Returns:
+        list[dict]: metadata list containing CPT codes, descriptions, and variants
     """
-    if not os.path.exists(os.path.dirname(FAISS_INDEX_FILE)):
-        os.makedirs(os.path.dirname(FAISS_INDEX_FILE))
-    faiss.write_index(index, FAISS_INDEX_FILE)
-
+    path = path or current_paths()["metadata"]
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"Metadata file not found: {path}")
+    with open(path, "r", encoding="utf-8") as f:
+        return flatten_legacy_metadata(json.load(f))
 
-def load_metadata():
+def flatten_legacy_metadata(metadata):
     """
-    Load CPT metadata JSON.
+    Older CPTUpdater.add_new_cpt calls stored {"CPT_Code", "formal_description", "nl_variants"}
+    entries in the row-aligned metadata while only the variants were embedded.
+    Expand them to one row per embedded variant so metadata rows line up with FAISS rows.
+    Args:
+        metadata (list[dict]): raw metadata list
     Returns:
-        list[dict]: metadata list containing CPT codes, descriptions, and variants
+        list[dict]: metadata with one {"CPT_Code", "source", "text"} row per FAISS vector
     """
-    if not os.path.exists(METADATA_FILE):
-        raise FileNotFoundError(f"Metadata file not found: {METADATA_FILE}")
-    with open(METADATA_FILE, "r", encoding="utf-8") as f:
-        return json.load(f)
+    flat = []
+    for m in metadata:
+        if "nl_variants" in m and "source" not in m:
+            flat.extend(
+                {"CPT_Code": m["CPT_Code"], "source": "variant", "text": v}
+                for v in m["nl_variants"]
+            )
+        else:
+            flat.append(m)
+    return flat
+
+def _create_embeddings(texts: list, timeout: float):
+    """Single embeddings request; retries/hedging are handled by the call policy."""
+    return client.with_options(timeout=timeout, max_retries=0).embeddings.create(
+        model=EMBED_MODEL, input=texts
+    )
 
 def embed_text(text: str):
     """
@@ -63,9 +91,38 @@ def embed_text(text: str):
     Returns:
         np.ndarray: 1 x embedding_dim float32 array
     """
-    response = client.embeddings.create(model=EMBED_MODEL, input=[text])
-    vector = np.array(response.data[0].embedding, dtype="float32").reshape(1, -1)
-    return vector
+    # Identical texts in flight share one request and concurrent distinct texts are
+    # micro-batched into one API call; each caller gets its own copy
+    return get_flight("embed_text").do(text, _embed_dispatcher, text).copy()
+
+def _embed_batch(texts: list):
+    """Embed a micro-batch of texts from concurrent callers; one 1 x dim row per caller."""
+    unique = list(dict.fromkeys(texts))
+    vectors = embed_texts(unique)
+    position = {t: i for i, t in enumerate(unique)}
+    return [vectors[position[t]].reshape(1, -1) for t in texts]
+
+def embed_texts(texts: list):
+    """
+    Generate embeddings for several texts in one batched OpenAI call.
+    Args:
+        texts (list[str]): texts to embed
+    Returns:
+        np.ndarray: len(texts) x embedding_dim float32 array (rows in input order)
+    """
+    if not texts:
+        return np.zeros((0, 0), dtype="float32")
+    response = get_policy("embed").call(_create_embeddings, list(texts))
+    # The API returns one item per input; sort by index to be safe
+    data = sorted(response.data, key=lambda d: d.index)
+    return np.array([d.embedding for d in data], dtype="float32")
+
+_embed_dispatcher = MicroBatcher(
+    _embed_batch,
+    max_batch_size=EMBED_BATCH_MAX_SIZE,
+    max_wait_ms=EMBED_BATCH_MAX_WAIT_MS,
+    name="embed-batcher",
+)
 
 def normalize_embedding(vec: np.ndarray):
     """
@@ -79,3 +136,16 @@ def normalize_embedding(vec: np.ndarray):
     if norm == 0:
         return vec
     return vec / norm
+
+def normalize_embeddings(mat: np.ndarray):
+    """
+    Row-wise normalization of a batch of embeddings for cosine similarity.
+    Args:
+        mat (np.ndarray): n x embedding_dim array
+    Returns:
+        np.ndarray: normalized float32 array (zero rows are left unchanged)
+    """
+    mat = np.asarray(mat, dtype="float32")
+    norms = np.linalg.norm(mat, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return mat / norms
@@ -0,0 +1,135 @@
+"""
+Tail-latency check for app/call_policy.py against a local fault-injecting stub.
+
+The stub mimics an upstream API: lognormal latency, occasional multi-second stalls,
+and a share of 429 / 503 errors. Each scenario fires the same workload and reports
+p50 / p95 / p99 latency plus failures, so hedging and retries can be compared, then checks
+that the policy actually bounds the tail: hedged p99 stays below the stall time and
+the breaker opens during a full outage. Exits non-zero if a check fails.
+
+Run from the repo root:
+    python benchmarks/bench_call_policy.py
+"""
+
+import os
+import random
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.call_policy import CallPolicy, CallPolicyError  # noqa: E402
+
+NUM_CALLS = int(os.getenv("NUM_CALLS", 400))
+CONCURRENCY = int(os.getenv("CONCURRENCY", 16))
+STALL_RATE = 0.03      # share of calls that hang for STALL_SECONDS
+STALL_SECONDS = 3.0
+ERROR_RATE = 0.05      # share of calls that fail with 429/503
+SEED = 7
+
+
+class StubStatusError(Exception):
+    """Stand-in for an HTTP status error from the client library."""
+
+    def __init__(self, status_code: int):
+        super().__init__(f"stub HTTP {status_code}")
+        self.status_code = status_code
+
+
+class FaultInjectingStub:
+    """Local fake upstream endpoint with latency outliers and transient errors."""
+
+    def __init__(self, seed: int = SEED):
+        self._rng = random.Random(seed)
+
+    def __call__(self, timeout: float = None):
+        roll = self._rng.random()
+        latency = self._rng.lognormvariate(-3.0, 0.4)  # ~50ms median
+        if roll < STALL_RATE:
+            latency = STALL_SECONDS
+        if timeout is not None and latency > timeout:
+            time.sleep(timeout)
+            raise TimeoutError("stub request timed out")
+        time.sleep(latency)
+        if roll > 1.0 - ERROR_RATE:
+            raise StubStatusError(self._rng.choice([429, 503]))
+        return "ok"
+
+
+def _percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def run_scenario(name: str, call):
+    latencies = []
+    failures = 0
+
+    def one(_):
+        started = time.monotonic()
+        try:
+            call()
+            ok = True
+        except Exception:
+            ok = False
+        return time.monotonic() - started, ok
+
+    with ThreadPoolExecutor(max_workers=CONCURRENCY) as pool:
+        for elapsed, ok in pool.map(one, range(NUM_CALLS)):
+            latencies.append(elapsed)
+            failures += 0 if ok else 1
+
+    print(f"{name:<22} p50={statistics.median(latencies) * 1000:7.1f}ms "
+          f"p95={_percentile(latencies, 0.95) * 1000:7.1f}ms "
+          f"p99={_percentile(latencies, 0.99) * 1000:7.1f}ms "
+          f"max={max(latencies) * 1000:7.1f}ms failures={failures}")
+    return latencies, failures
+
+
+def main():
+    failed_checks = []
+
+    def check(ok: bool, message: str):
+        print(f"  [{'ok' if ok else 'FAIL'}] {message}")
+        if not ok:
+            failed_checks.append(message)
+
+    stub = FaultInjectingStub()
+    run_scenario("no policy", lambda: stub(timeout=None))
+
+    retry_only = CallPolicy("bench-retry", deadline=5.0, hedge=False)
+    run_scenario("retry + deadline", lambda: retry_only.call(stub))
+    print(f"  stats: {retry_only.stats}")
+
+    hedged = CallPolicy("bench-hedged", deadline=5.0)
+    latencies, failures = run_scenario("retry + hedge", lambda: hedged.call(stub))
+    print(f"  stats: {hedged.stats}")
+    p99 = _percentile(latencies, 0.99)
+    check(p99 < STALL_SECONDS, f"hedged p99 {p99 * 1000:.0f}ms < stall {STALL_SECONDS * 1000:.0f}ms")
+    check(failures <= NUM_CALLS * ERROR_RATE / 5, f"hedged failures {failures} well below the raw error rate")
+
+    # Full outage: the breaker should open and reject the rest without waiting
+    def outage(timeout: float = None):
+        time.sleep(0.05)
+        raise StubStatusError(503)
+
+    breaker = CallPolicy("bench-breaker", deadline=2.0, max_retries=0, failure_threshold=3)
+    started = time.monotonic()
+    for _ in range(20):
+        try:
+            breaker.call(outage)
+        except (CallPolicyError, StubStatusError):
+            pass
+    print(f"outage x20: circuit={breaker.breaker.state} rejected={breaker.stats['rejected']} "
+          f"elapsed={(time.monotonic() - started) * 1000:.0f}ms")
+    check(breaker.breaker.state == "open", "breaker open after a full outage")
+    check(breaker.stats["rejected"] >= 15, f"{breaker.stats['rejected']} of 20 outage calls rejected without waiting")
+
+    if failed_checks:
+        sys.exit(f"{len(failed_checks)} check(s) failed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Throughput of per-call vs micro-batched embedding + FAISS search under concurrency.
+
+A local stub stands in for the embeddings endpoint: each request costs a fixed
+round-trip plus a small per-input cost, and the upstream only serves a limited
+number of requests at once (as with a rate-limited API key). The FAISS side is a
+real IndexFlatL2 over random 1536-d vectors the size of the CPT corpus.
+
+Run from the repo root:
+    python benchmarks/bench_micro_batching.py
+"""
+
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import faiss
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.micro_batcher import MicroBatcher  # noqa: E402
+
+DIM = 1536
+CORPUS = 11770
+TOP_K = 5
+ROUND_TRIP_S = 0.060      # per request
+PER_INPUT_S = 0.0002      # per text in a request
+UPSTREAM_CONCURRENCY = 8  # requests the stub serves in parallel
+REQUESTS_PER_LEVEL = 400
+LEVELS = [50, 100, 200]
+
+
+class StubEmbeddings:
+    """Fake embeddings endpoint with round-trip latency and bounded concurrency."""
+
+    def __init__(self):
+        self._slots = threading.Semaphore(UPSTREAM_CONCURRENCY)
+        self.requests = 0
+
+    def create(self, texts):
+        with self._slots:
+            self.requests += 1
+            time.sleep(ROUND_TRIP_S + PER_INPUT_S * len(texts))
+        rng = np.random.default_rng(abs(hash(texts[0])) % (2 ** 32))
+        vecs = rng.standard_normal((len(texts), DIM)).astype("float32")
+        faiss.normalize_L2(vecs)
+        return vecs
+
+
+def build_index():
+    rng = np.random.default_rng(0)
+    vecs = rng.standard_normal((CORPUS, DIM)).astype("float32")
+    faiss.normalize_L2(vecs)
+    index = faiss.IndexFlatL2(DIM)
+    index.add(vecs)
+    return index
+
+
+def run_level(concurrency, retrieve):
+    notes = [f"note {i}" for i in range(REQUESTS_PER_LEVEL)]
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(retrieve, notes))
+    elapsed = time.monotonic() - started
+    return REQUESTS_PER_LEVEL / elapsed
+
+
+def main():
+    index = build_index()
+
+    for concurrency in LEVELS:
+        stub = StubEmbeddings()
+
+        def per_call(note):
+            vec = stub.create([note])
+            return index.search(vec, TOP_K)
+
+        unbatched_rps = run_level(concurrency, per_call)
+        unbatched_requests = stub.requests
+
+        stub = StubEmbeddings()
+
+        def process(notes):
+            vecs = stub.create(notes)
+            _, ids = index.search(vecs, TOP_K)  # one matrix query for the micro-batch
+            return list(ids)
+
+        batcher = MicroBatcher(process, max_batch_size=64, max_wait_ms=5)
+        batched_rps = run_level(concurrency, batcher)
+
+        print(f"concurrency={concurrency:>3}  per-call: {unbatched_rps:7.1f} req/s "
+              f"({unbatched_requests} upstream calls)  micro-batched: {batched_rps:7.1f} req/s "
+              f"({stub.requests} upstream calls, {batcher.stats['batches']} batches, "
+              f"max batch {batcher.stats['max_batch']})")
+
+
+if __name__ == "__main__":
+    main()
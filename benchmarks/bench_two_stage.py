@@ -0,0 +1,142 @@
+"""
+Single-stage flat search vs two-stage (coarse 256/512-d + full-dimension re-rank).
+
+Reports recall@k against exact full-dimension flat search, per-query latency and
+process RSS. Each configuration runs in its own subprocess so RSS is not shared.
+
+Uses the real corpus vectors from the live KB version's flat index when present; otherwise falls
+back to synthetic vectors with a decaying per-dimension spectrum (shortened
+text-embedding-3 vectors keep most of their signal in the leading dimensions, random
+isotropic vectors would not).
+
+Run from the repo root:
+    python benchmarks/bench_two_stage.py
+"""
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import faiss
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.kb_store import current_paths  # noqa: E402
+from app.two_stage import TwoStageRetriever, build_two_stage  # noqa: E402
+
+TOP_K = 10
+NUM_QUERIES = 300
+COARSE_DIMS = [256, 512]
+RERANK_DEPTH = 200
+SYNTHETIC_ROWS = 11770
+SYNTHETIC_DIM = 1536
+
+
+def _rss_mb():
+    """(anonymous, file-backed) resident memory in MB; memory-mapped pages count as file-backed."""
+    rss = {}
+    with open("/proc/self/status") as f:
+        for line in f:
+            key = line.split(":")[0]
+            if key in ("RssAnon", "RssFile"):
+                rss[key] = int(line.split()[1]) / 1024.0
+    return rss.get("RssAnon", float("nan")), rss.get("RssFile", float("nan"))
+
+
+def _corpus():
+    flat_index = current_paths()["index"]
+    if os.path.exists(flat_index):
+        index = faiss.read_index(flat_index)
+        return index.reconstruct_n(0, index.ntotal), flat_index
+    rng = np.random.default_rng(0)
+    scale = 1.0 / np.sqrt(1.0 + np.arange(SYNTHETIC_DIM) / 64.0)
+    vecs = (rng.standard_normal((SYNTHETIC_ROWS, SYNTHETIC_DIM)) * scale).astype("float32")
+    return vecs, "synthetic"
+
+
+def prepare(workdir):
+    vectors, origin = _corpus()
+    vectors = np.ascontiguousarray(vectors, dtype="float32")
+    faiss.normalize_L2(vectors)
+
+    flat = faiss.IndexFlatL2(vectors.shape[1])
+    flat.add(vectors)
+    faiss.write_index(flat, os.path.join(workdir, "flat.index"))
+    build_two_stage(vectors, COARSE_DIMS,
+                    full_path=os.path.join(workdir, "full.npy"),
+                    coarse_template=os.path.join(workdir, "coarse_{dim}.index"))
+
+    # Queries: perturbed corpus rows (near, but not identical to, stored vectors)
+    rng = np.random.default_rng(1)
+    rows = rng.choice(vectors.shape[0], NUM_QUERIES, replace=False)
+    queries = vectors[rows] + 0.03 * rng.standard_normal((NUM_QUERIES, vectors.shape[1])).astype("float32")
+    faiss.normalize_L2(queries)
+    np.save(os.path.join(workdir, "queries.npy"), queries)
+    return origin, vectors.shape
+
+
+def child(mode, workdir):
+    """Load one configuration, run queries one at a time, print JSON results."""
+    rss_start = _rss_mb()
+    queries = np.load(os.path.join(workdir, "queries.npy"))
+    if mode == "flat":
+        index = faiss.read_index(os.path.join(workdir, "flat.index"))
+        search = lambda q: index.search(q, TOP_K)  # noqa: E731
+    else:
+        dim = int(mode.split(":")[1])
+        retriever = TwoStageRetriever.load(
+            dim, rerank_depth=RERANK_DEPTH,
+            full_path=os.path.join(workdir, "full.npy"),
+            coarse_template=os.path.join(workdir, "coarse_{dim}.index"),
+        )
+        search = lambda q: retriever.search(q, TOP_K)  # noqa: E731
+
+    latencies, ids = [], []
+    for i in range(queries.shape[0]):
+        started = time.perf_counter()
+        _, found = search(queries[i:i + 1])
+        latencies.append(time.perf_counter() - started)
+        ids.append(found[0].tolist())
+
+    print(json.dumps({
+        "ids": ids,
+        "latencies": latencies,
+        "rss_anon_mb": _rss_mb()[0] - rss_start[0],
+        "rss_file_mb": _rss_mb()[1] - rss_start[1],
+    }))
+
+
+def main():
+    with tempfile.TemporaryDirectory() as workdir:
+        origin, shape = prepare(workdir)
+        print(f"corpus: {origin} {shape[0]} x {shape[1]}, {NUM_QUERIES} queries, "
+              f"top_k={TOP_K}, rerank_depth={RERANK_DEPTH}")
+
+        results = {}
+        for mode in ["flat"] + [f"two_stage:{d}" for d in COARSE_DIMS]:
+            out = subprocess.run([sys.executable, __file__, "--child", mode, workdir],
+                                 check=True, capture_output=True, text=True).stdout
+            results[mode] = json.loads(out)
+
+        truth = results["flat"]["ids"]
+        for mode, res in results.items():
+            lat = np.array(res["latencies"]) * 1000
+            recall = {
+                k: np.mean([len(set(r[:k]) & set(t[:k])) / k for r, t in zip(res["ids"], truth)])
+                for k in (1, 5, TOP_K)
+            }
+            print(f"{mode:<14} recall@1={recall[1]:.3f} recall@5={recall[5]:.3f} "
+                  f"recall@{TOP_K}={recall[TOP_K]:.3f}  "
+                  f"p50={np.percentile(lat, 50):6.2f}ms p95={np.percentile(lat, 95):6.2f}ms  "
+                  f"rss+ anon={res['rss_anon_mb']:.1f}MB file={res['rss_file_mb']:.1f}MB")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == "--child":
+        child(sys.argv[2], sys.argv[3])
+    else:
+        main()
@@ -15,20 +15,28 @@
 """
 
 import os
+import sys
 import json
 import faiss
 import numpy as np
 from openai import OpenAI
 from dotenv import load_dotenv
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.kb_store import publish_version  # noqa: E402
+
 # Load environment variables
 load_dotenv()
 client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
 # File paths
 INPUT_JSON = "cpt_with_nl_variants.json"   # your enriched CPT+variants file
-FAISS_INDEX_FILE = "../data/cpt_faiss.index"
-METADATA_FILE = "../data/cpt_metadata.json"
+# Knowledge-base root: the build is published as a new version (see app/kb_store.py)
+DATA_DIR = "../data"
+
+# Two-stage retrieval artefacts (see app/two_stage.py)
+COARSE_DIMS = [int(d) for d in os.getenv("COARSE_DIMS", "256,512").split(",") if d.strip()]
 
 # Embedding model
 EMBED_MODEL = "text-embedding-3-small"  # cheaper, or "text-embedding-3-large"
@@ -96,14 +104,12 @@ def build_index():
     index = faiss.IndexFlatL2(dim)  # L2 distance index
     index.add(embeddings_np)
 
-    # Save FAISS index
-    faiss.write_index(index, FAISS_INDEX_FILE)
-    print(f"FAISS index saved to {FAISS_INDEX_FILE}")
-
-    # Save metadata
-    with open(METADATA_FILE, "w", encoding="utf-8") as f:
-        json.dump(metadata, f, indent=2)
-    print(f"Metadata saved to {METADATA_FILE}")
+    # Save FAISS index + metadata + two-stage artefacts (full-dimension vectors and one
+    # coarse index per COARSE_DIMS entry) as one version, the same way CPTUpdater does
+    record = publish_version(index, metadata, {"source": INPUT_JSON}, coarse_dims=COARSE_DIMS,
+                             data_dir=DATA_DIR)
+    print(f"FAISS index, metadata and coarse {COARSE_DIMS}-d indexes published "
+          f"as version {record['version']} in {DATA_DIR}/{record['dir']}")
 
 if __name__ == "__main__":
     build_index()